@@ -1,25 +1,49 @@
-from boto import connect_s3
-from lxml import html
 from lxml.etree import ParserError
-from pygraph.classes.digraph import digraph
-from pygraph.algorithms.pagerank import pagerank
-from pygraph.classes.exceptions import AdditionError
 from wikia_authority import MinMaxScaler
+from wikia_authority import session
+from wikia_authority.fetch import FetchEngine
+from wikia_authority.ratelimit import RateLimiter
+from wikia_authority.cache import ResponseCache
+from wikia_authority.distances import EditDistanceStore
+from wikia_authority import worddiff
+from wikia_authority import graph
+from wikia_authority.storage import open_result_store, file_digest
+from wikia_authority.bundle import write_bundle
+from wikia_authority.jsonstream import write_json, write_json_gz
+from wikia_authority.revisions import RevisionStore, RevisionStoreBuilder
+from wikia_authority.checkpoint import Checkpoint, replace_directory
 import traceback
 import json
 import requests
 import sys
 import multiprocessing
 import argparse
+import heapq
 import time
+import os
+import shutil
+import glob
+import tempfile
 
 
 minimum_authors = 5
 minimum_contribution_pct = 0.05
 smoothing = 0.05
+revision_batch_size = 50
+revision_walk_limit = 5
+link_batch_size = 500
 wiki_id = None
 api_url = None
-edit_distance_memoization_cache = {}
+edit_distance_store = None
+diff_mode = u'api'
+revision_texts = None
+connection_stats = None
+rate_limiter = None
+response_cache = None
+fetch_engine = None
+revision_store = None
+result_store = None
+known_revisions = {}  # pageid -> newest revid an earlier run already has
 
 
 class Unbuffered:
@@ -37,33 +61,172 @@ class Unbuffered:
 sys.stdout = Unbuffered(sys.stdout)
 
 
+def init_worker(http_pool_size, counters, limiter, cache, fetch_concurrency, results, revision_store_path=None):
+    global fetch_engine, revision_store, result_store
+    session.init_session(pool_size=max(http_pool_size, fetch_concurrency), counters=counters, limiter=limiter,
+                         cache=cache)
+    fetch_engine = FetchEngine(concurrency=fetch_concurrency)
+    result_store = results
+    if revision_store_path is not None:
+        # every worker maps the same files, so the pages share one copy in the page cache;
+        # pages don't overlap, so workers can write their longevity straight into it
+        revision_store = RevisionStore.load(revision_store_path, mmap_mode=u'r', writable=[u'longevity', u'scored'])
+
+
+def get_pool(args, revision_store_path=None):
+    global connection_stats, rate_limiter, response_cache, result_store
+    # the process pool is only there for cpu-bound work; split the in-flight request budget across it
+    worker_concurrency = max(1, args.fetch_concurrency / args.processes)
+    return multiprocessing.Pool(processes=args.processes, initializer=init_worker,
+                                initargs=(args.http_pool_size, connection_stats, rate_limiter, response_cache,
+                                          worker_concurrency, result_store, revision_store_path))
+
+
+def page_key(doc_id):
+    return u'/service_responses/%s/PageAuthorityService.get' % doc_id.replace(u'_', u'/')
+
+
 # multiprocessing's gotta grow up and let me do anonymous functions
-def set_page_key(x):
-    bucket = connect_s3().get_bucket(u'nlp-data')
-    k = bucket.new_key(key_name=u'/service_responses/%s/PageAuthorityService.get' % (x[0].replace(u'_', u'/')))
-    k.set_contents_from_string(json.dumps(x[1], ensure_ascii=False))
-    return True
+def set_page_keys(items):
+    """
+    Writes the pages in a batch of (doc_id, authors, previous digest) whose authors changed since the last run
+    through this worker's result store. Returns what put_changed does.
+    """
+    global result_store
+    return result_store.put_changed([(page_key(doc_id), json.dumps(authors, ensure_ascii=False), previous_digest)
+                                     for doc_id, authors, previous_digest in items])
+
+
+def upload_page_keys(args, title_top_authors, checkpoint, previous_digests):
+    """
+    Writes every page's authors in batches across the pool, skipping pages the checkpoint says are already up
+    and pages whose authors hash the same as they did in previous_digests. Returns the writes and bytes skipped.
+    """
+    upload_log = checkpoint.log(u'uploads')
+    uploaded = set([key for key, key_digest in upload_log.read()])
+    pending = [(doc_id, authors, previous_digests.get(page_key(doc_id)))
+               for doc_id, authors in title_top_authors.items() if page_key(doc_id) not in uploaded]
+    batches = [pending[i:i+args.upload_batch_size] for i in range(0, len(pending), args.upload_batch_size)]
+    start, keys, written, skipped, saved = time.time(), 0, 0, 0, 0
+    pool = get_pool(args)
+    for digests, batch_bytes, batch_skipped, batch_saved in pool.imap_unordered(set_page_keys, batches):
+        for key_digest in digests:
+            upload_log.append(key_digest)
+        keys += len(digests) - batch_skipped
+        written += batch_bytes
+        skipped += batch_skipped
+        saved += batch_saved
+    upload_log.close()
+    pool.close()
+    pool.join()
+    seconds = time.time() - start
+    print u"Wrote %d page keys (%d bytes) in %.1f seconds, %.1f keys/sec; %d were unchanged" % (
+        keys, written, seconds, keys / max(seconds, 0.001), skipped)
+    return skipped, saved
+
+
+def put_changed_file(key, path, checkpoint, previous_digests):
+    """
+    Streams a file up under key unless it's the same as what previous_digests says was written last time,
+    logging it with the page keys. Returns the writes and bytes skipped.
+    """
+    global result_store
+    key_digest = file_digest(path)
+    skipped, saved = 0, 0
+    if key_digest == previous_digests.get(key):
+        skipped, saved = 1, os.path.getsize(path)
+    else:
+        result_store.put_file(key, path)
+    upload_log = checkpoint.log(u'uploads')
+    upload_log.append([key, key_digest])
+    upload_log.close()
+    return skipped, saved
+
+
+def write_page_bundle(title_top_authors, checkpoint, previous_digests):
+    """
+    Writes every page's authors as one bundle object, built in the checkpoint directory first,
+    unless it's the same as the last run's. Returns the writes and bytes skipped.
+    """
+    global wiki_id
+    start = time.time()
+    path = checkpoint.path(u'PageAuthorityService.bundle')
+    with open(path, u'wb') as bundle_file:
+        pages = write_bundle(bundle_file, title_top_authors.items())
+    skipped, saved = put_changed_file(u'service_responses/%s/PageAuthorityService.bundle' % wiki_id, path,
+                                      checkpoint, previous_digests)
+    if skipped:
+        print u"Bundle of %d pages' authors is unchanged" % pages
+    else:
+        print u"Wrote %d pages' authors as one %d byte bundle in %.1f seconds" % (
+            pages, os.path.getsize(path), time.time() - start)
+    return skipped, saved
+
+
+def put_wiki_keys(items, checkpoint, previous_digests, gzipped=False):
+    """
+    Writes each (key, mapping) in items as JSON, and with gzipped, as gzipped JSON under key + .gz too.
+    Each is encoded a slice at a time into the checkpoint directory and streamed up from there, so no
+    mapping is ever one string in memory. Returns the writes and bytes skipped.
+    """
+    skipped, saved = 0, 0
+    for key, mapping in items:
+        name = key.split(u'/')[-1]
+        files = [(key, checkpoint.path(name))]
+        json_bytes = write_json(files[0][1], mapping)
+        if gzipped:
+            files.append((key + u'.gz', checkpoint.path(name + u'.gz')))
+            write_json_gz(files[1][1], mapping)
+            print u"Gzipped %s from %d to %d bytes" % (name, json_bytes, os.path.getsize(files[1][1]))
+        for file_key, path in files:
+            key_skipped, key_saved = put_changed_file(file_key, path, checkpoint, previous_digests)
+            skipped += key_skipped
+            saved += key_saved
+    return skipped, saved
+
+
+def manifest_key():
+    global wiki_id
+    return u'service_responses/%s/ResultManifest.json' % wiki_id
 
 
-def get_all_titles(aplimit=500):
+def previous_manifest(args):
+    """
+    The digest of every key the last run wrote, or nothing on a full refresh
+    """
+    global result_store
+    if not args.incremental:
+        return {}
+    manifest = result_store.get(manifest_key())
+    return json.loads(manifest) if manifest is not None else {}
+
+
+def iter_title_batches(aplimit=500):
+    """
+    Yields each allpages batch as soon as it lands, so later stages can start on it
+    while the rest of the enumeration is still running
+    """
     global api_url
     params = {u'action': u'query', u'list': u'allpages', u'aplimit': aplimit,
               u'apfilterredir': u'nonredirects', u'format': u'json'}
-    allpages = []
     while True:
-        resp = requests.get(api_url, params=params)
-        response = resp.json()
-        resp.close()
-        allpages += response.get(u'query', {}).get(u'allpages', [])
+        response = session.get_json(api_url, params=params)
+        yield response.get(u'query', {}).get(u'allpages', [])
         if u'query-continue' in response:
             params[u'apfrom'] = response[u'query-continue'][u'allpages'][u'apfrom']
         else:
             break
-    return allpages
+
+
+def get_all_titles(aplimit=500):
+    return [title_object for title_batch in iter_title_batches(aplimit=aplimit) for title_object in title_batch]
 
 
 def get_all_revisions(title_object):
-    global api_url
+    """
+    [title, revisions] oldest first; for a page in known_revisions, only the revisions after the one already held
+    """
+    global api_url, known_revisions
     title_string = title_object[u'title']
     params = {u'action': u'query',
               u'prop': u'revisions',
@@ -72,28 +235,170 @@ def get_all_revisions(title_object):
               u'rvlimit': u'max',
               u'rvdir': u'newer',
               u'format': u'json'}
+    since = known_revisions.get(title_object[u'pageid'])
+    if since is not None:
+        params[u'rvstartid'] = since
     revisions = []
     while True:
-        resp = requests.get(api_url, params=params)
         try:
-            response = resp.json()
+            response = session.get_json(api_url, params=params)
         except ValueError as e:
             print e, traceback.format_exc()
-            print response.content
-            return revisions
-        resp.close()
+            break
         revisions += response.get(u'query', {}).get(u'pages', {0: {}}).values()[0].get(u'revisions', [])
         if u'query-continue' in response:
             params[u'rvstartid'] = response[u'query-continue'][u'revisions'][u'rvstartid']
         else:
             break
+    if since is not None:
+        revisions = [revision for revision in revisions if revision.get(u'revid') != since]
     return [title_string, revisions]
 
 
-def edit_distance(title_object, earlier_revision, later_revision, already_retried=False):
-    global api_url, edit_distance_memoization_cache
-    if (earlier_revision, later_revision) in edit_distance_memoization_cache:
-        return edit_distance_memoization_cache[(earlier_revision, later_revision)]
+def query_revisions(ids_param, ids):
+    global api_url
+    params = {u'action': u'query',
+              u'prop': u'revisions',
+              ids_param: u'|'.join(map(unicode, ids)),
+              u'rvprop': u'ids|user|userid',
+              u'format': u'json'}
+    try:
+        # specific revisions never change, only whole-page listings do
+        response = session.get_json(api_url, params=params, permanent=(ids_param == u'revids'))
+    except ValueError as e:
+        print e, traceback.format_exc()
+        return []
+    return response.get(u'query', {}).get(u'pages', {}).values()
+
+
+def get_revisions_batch(title_objects):
+    """
+    Same output as mapping get_all_revisions over title_objects, in far fewer requests for short pages.
+    The API only enumerates history for a single page, so instead we ask for the top revision of up to
+    revision_batch_size pages at once and walk each page back through parentid, packing every page's
+    next revid into shared revids= queries. Pages still unfinished after revision_walk_limit steps, or
+    whose chain breaks on a hidden revision, fall back to the per-page query. A walk also stops at the
+    page's revid in known_revisions, so pages an earlier run has seen only come back with what's new.
+    """
+    global revision_batch_size, revision_walk_limit, known_revisions
+    pages = dict([(title_object[u'pageid'], {u'title_object': title_object, u'revisions': [], u'fallback': False,
+                                             u'since': known_revisions.get(title_object[u'pageid'])})
+                  for title_object in title_objects])
+    pending = {}  # revid to fetch -> pageid; each page has at most one in flight, so this is its continuation
+
+    def take(page_responses):
+        for page_response in page_responses:
+            page = pages.get(page_response.get(u'pageid'))
+            if page is None:
+                continue
+            for revision in page_response.get(u'revisions', []):
+                if page[u'since'] is not None and revision.get(u'revid') == page[u'since']:
+                    continue  # nothing new on this page
+                page[u'revisions'].append(revision)
+                if revision.get(u'parentid', 0) == 0 or revision.get(u'parentid') == page[u'since']:
+                    continue
+                if len(page[u'revisions']) >= revision_walk_limit:
+                    page[u'fallback'] = True
+                else:
+                    pending[revision[u'parentid']] = page_response[u'pageid']
+
+    pageids = pages.keys()
+    for i in range(0, len(pageids), revision_batch_size):
+        take(query_revisions(u'pageids', pageids[i:i+revision_batch_size]))
+    for pageid, page in pages.items():
+        if len(page[u'revisions']) == 0 and page[u'since'] is None:
+            page[u'fallback'] = True
+
+    while len(pending) > 0:
+        revids = pending.keys()[:revision_batch_size]
+        requested = dict([(revid, pending.pop(revid)) for revid in revids])
+        returned_before = dict([(pageid, len(page[u'revisions'])) for pageid, page in pages.items()])
+        take(query_revisions(u'revids', revids))
+        for revid, pageid in requested.items():
+            if len(pages[pageid][u'revisions']) == returned_before[pageid]:
+                pages[pageid][u'fallback'] = True  # deleted or suppressed revision broke the chain
+
+    results = []
+    for title_object in title_objects:
+        page = pages[title_object[u'pageid']]
+        if page[u'fallback']:
+            results.append(get_all_revisions(title_object))
+        else:
+            results.append([title_object[u'title'], list(reversed(page[u'revisions']))])
+    return results
+
+
+def get_revisions_per_page(title_objects):
+    return map(get_all_revisions, title_objects)
+
+
+def revision_tasks(title_batches):
+    global revision_batch_size
+    task_size = max(1, revision_batch_size)
+    for title_batch in title_batches:
+        for i in range(0, len(title_batch), task_size):
+            yield title_batch[i:i+task_size]
+
+
+def iter_all_revisions(title_batches):
+    """
+    Yields [title, revisions] in completion order. title_batches is consumed lazily by the
+    fetch engine's task thread, so enumeration keeps going while revisions are fetched.
+    """
+    global fetch_engine, revision_batch_size
+    fetch = get_revisions_batch if revision_batch_size > 1 else get_revisions_per_page
+    for task_results in fetch_engine.imap_unordered(fetch, revision_tasks(title_batches)):
+        for result in task_results:
+            yield result
+
+
+def fetch_revision_texts(revids):
+    global api_url
+    params = {u'action': u'query',
+              u'prop': u'revisions',
+              u'revids': u'|'.join(map(unicode, revids)),
+              u'rvprop': u'ids|content',
+              u'format': u'json'}
+    try:
+        response = session.get_json(api_url, params=params, permanent=True)
+    except (requests.exceptions.ConnectionError, ValueError) as e:
+        print e, traceback.format_exc()
+        return {}
+    return dict([(revision[u'revid'], revision[u'*'])
+                 for page in response.get(u'query', {}).get(u'pages', {}).values()
+                 for revision in page.get(u'revisions', []) if u'*' in revision])
+
+
+def local_edit_distance(earlier_revision, later_revision):
+    global revision_texts
+    if earlier_revision == 0:
+        return None  # first revision of a page; there's no diff to take
+    earlier_text, later_text = revision_texts.get(earlier_revision), revision_texts.get(later_revision)
+    if earlier_text is None or later_text is None:
+        return None
+    return worddiff.score_words(*worddiff.text_diff_words(earlier_text, later_text))
+
+
+def edit_distance_store_key():
+    global wiki_id, diff_mode
+    # local diffs only approximate the rendered ones, so keep the two apart
+    return wiki_id if diff_mode == u'api' else u'%s/%s' % (wiki_id, diff_mode)
+
+
+def edit_distance(title_object, earlier_revision, later_revision):
+    global api_url, edit_distance_store, diff_mode
+    store_key = edit_distance_store_key()
+    if edit_distance_store is not None:
+        distance = edit_distance_store.get(store_key, earlier_revision, later_revision)
+        if distance is not None:
+            return distance
+    if diff_mode == u'local':
+        distance = local_edit_distance(earlier_revision, later_revision)
+        if distance is None:
+            return 0
+        if edit_distance_store is not None:
+            edit_distance_store.put(store_key, earlier_revision, later_revision, distance)
+        return distance
     params = {u'action': u'query',
               u'prop': u'revisions',
               u'rvprop': u'ids|user|userid',
@@ -104,82 +409,122 @@ def edit_distance(title_object, earlier_revision, later_revision, already_retrie
               u'titles': title_object[u'title']}
 
     try:
-        resp = requests.get(api_url, params=params)
+        # throttled and retried by the shared rate limiter; a diff between fixed revids is cached for good
+        response = session.get_json(api_url, params=params, permanent=True)
     except requests.exceptions.ConnectionError as e:
-        if already_retried:
-            print u"Gave up on some socket shit", e
-            return 0
-        print u"Fucking sockets"
-        time.sleep(240)  # wait four minutes for your wimpy ass sockets to get their shit together
-        return edit_distance(title_object, earlier_revision, later_revision, already_retried=True)
-
-    try:
-        response = resp.json()
+        print u"Gave up on some socket shit", e
+        return 0
     except ValueError as e:
         print e, traceback.format_exc()
-        print resp.content
         return 0
-    resp.close()
-    time.sleep(0.025)  # prophylactic throttling
     revision = (response.get(u'query', {})
                         .get(u'pages', {0: {}})
                         .get(unicode(title_object[u'pageid']), {})
                         .get(u'revisions', [{}])[0])
-    revision[u'adds'], revision[u'deletes'], revision[u'moves'] = 0, 0, 0
     if (u'diff' in revision and u'*' in revision[u'diff']
        and revision[u'diff'][u'*'] != '' and revision[u'diff'][u'*'] is not False
        and revision[u'diff'][u'*'] is not None):
         try:
-            diff_dom = html.fromstring(revision[u'diff'][u'*'])
-            deleted = [word for span in diff_dom.cssselect(u'td.diff-deletedline span.diffchange-inline')
-                       for word in span.text_content().split(' ')]
-            added = [word for span in diff_dom.cssselect(u'td.diff-addedline span.diffchange-inline')
-                     for word in span.text_content().split(' ')]
-            adds = sum([1 for word in added if word not in deleted])
-            deletes = sum([1 for word in deleted if word not in added])
-            moves = sum([1 for word in added if word in deleted])
-            changes = revision[u'adds']+revision[u'deletes']+revision[u'moves']  # bad approx. of % of document
-            if changes > 0:
-                moves /= changes
-            distance = max([adds, deletes]) - 0.5 * min([adds, deletes]) + moves
-            edit_distance_memoization_cache[(earlier_revision, later_revision)] = distance
+            distance = worddiff.score_words(*worddiff.html_diff_words(revision[u'diff'][u'*']))
+            if edit_distance_store is not None:
+                edit_distance_store.put(store_key, earlier_revision, later_revision, distance)
             return distance
         except (TypeError, ParserError, UnicodeEncodeError):
             return 0
     return 0
 
 
-def edit_quality(title_object, revision_i, revision_j):
+def edit_windows(title_revs, start=0):
+    """
+    Yields each revision's index, from start on, along with the (revision, next revision) pairs
+    by other authors whose edit quality feeds that revision's longevity
+    """
+    for i in range(start, len(title_revs)):
+        curr_rev = title_revs[i]
+        yield i, [(title_revs[j-1], title_revs[j]) for j in range(i+1, len(title_revs[i+1:i+11]))
+                  if title_revs[j].get(u'user', u'') != curr_rev.get(u'user')]
+
 
-    numerator = (edit_distance(title_object, revision_i[u'parentid'], revision_j[u'revid'])
-                 - edit_distance(title_object, revision_i[u'revid'], revision_j[u'revid']))
+def edit_quality_pairs(revision_i, revision_j):
+    return [(revision_i[u'parentid'], revision_j[u'revid']),
+            (revision_i[u'revid'], revision_j[u'revid']),
+            (revision_i[u'parentid'], revision_i[u'revid'])]
 
-    denominator = edit_distance(title_object, revision_i[u'parentid'], revision_i[u'revid'])
+
+def plan_revision_pairs(title_revs, start=0):
+    """
+    Every distinct (earlier, later) revision pair get_contributing_authors needs a distance for.
+    Neighboring windows overlap heavily, so this is far smaller than the number of lookups.
+    """
+    pairs = set()
+    for i, non_author_revs_comps in edit_windows(title_revs, start):
+        if i > 0:
+            if u'revid' not in title_revs[i] or u'revid' not in title_revs[i-1]:
+                continue
+            pairs.add((title_revs[i-1][u'revid'], title_revs[i][u'revid']))
+        for revision_i, revision_j in non_author_revs_comps:
+            try:
+                pairs.update(edit_quality_pairs(revision_i, revision_j))
+            except KeyError:
+                pass  # the longevity math trips over the same revision and gives up on the page
+    return pairs
+
+
+def get_edit_distances(title_object, revision_pairs):
+    """
+    Distance table for the given pairs. API diffs go out concurrently on the fetch engine; local diffs
+    are cpu-bound, so they run in order of revision to keep the text cache walking forward.
+    """
+    global fetch_engine, diff_mode
+    pairs = sorted(revision_pairs, key=lambda pair: (pair[1], pair[0]))
+    compute = lambda pair: edit_distance(title_object, pair[0], pair[1])
+    if fetch_engine is not None and diff_mode == u'api':
+        distances = fetch_engine.map(compute, pairs)
+    else:
+        distances = map(compute, pairs)
+    return dict(zip(pairs, distances))
+
+
+def edit_quality(distances, revision_i, revision_j):
+
+    parent_to_j, i_to_j, parent_to_i = [distances[pair] for pair in edit_quality_pairs(revision_i, revision_j)]
+
+    numerator = parent_to_j - i_to_j
+
+    denominator = parent_to_i
 
     val = numerator if denominator == 0 or numerator == 0 else numerator / denominator
     return -1 if val < 0 else 1  # must be one of[-1, 1]
 
 
-def get_contributing_authors_safe(arg_tuple):
-    global wiki_id
+def get_page_authors_safe(page_index):
+    """
+    Top authors for one page of this worker's memory-mapped revision store. Only revisions whose
+    longevity isn't already in the store get scored, and what they score is written back to it.
+    """
+    global wiki_id, edit_distance_store, revision_store
+    title_object, title_revs = revision_store.title_object(page_index), revision_store.page_revisions(page_index)
     try:
-        res = get_contributing_authors(arg_tuple)
+        res = get_contributing_authors((title_object, title_revs), start=revision_store.unscored_start(page_index))
     except Exception as e:
         print e, traceback.format_exc()
-        return str(wiki_id) + '_' + str(arg_tuple[0][u'pageid']), []
+        return str(wiki_id) + '_' + str(title_object[u'pageid']), []
+    finally:
+        if edit_distance_store is not None:
+            edit_distance_store.flush()
+    revision_store.record_longevity(page_index, title_revs)
     return res
 
 
-def get_contributing_authors(arg_tuple):
-    global minimum_authors, minimum_contribution_pct, smoothing, wiki_id
-
-    #  within scope of map_async subprocess
-    requests.Session().mount(u'http://',
-                             requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1, pool_block=True))
+def get_contributing_authors(arg_tuple, start=0):
+    """
+    Works out edit longevity for the revisions from start on -- earlier ones keep the edit_longevity
+    they come with -- then picks the page's top authors
+    """
+    global smoothing, wiki_id, revision_texts, diff_mode
 
     title_object, title_revs = arg_tuple
     doc_id = "%s_%s" % (str(wiki_id), title_object[u'pageid'])
-    top_authors = []
     if len(title_revs) == 1 and u'user' in title_revs[0]:
         return doc_id, []
         # will this fix the bug?
@@ -187,7 +532,14 @@ def get_contributing_authors(arg_tuple):
         title_revs[0][u'contribs'] = 1
         return doc_id, title_revs
 
-    for i in range(0, len(title_revs)):
+    if diff_mode == u'local':
+        revids = [title_rev[u'revid'] for title_rev in title_revs if u'revid' in title_rev]
+        revision_texts = worddiff.RevisionTextCache(fetch_revision_texts, revids)
+
+    # every distance the windows below need, deduplicated and fetched together up front
+    distances = get_edit_distances(title_object, plan_revision_pairs(title_revs, start))
+
+    for i, non_author_revs_comps in edit_windows(title_revs, start):
         curr_rev = title_revs[i]
         if i == 0:
             edit_dist = 1
@@ -195,43 +547,42 @@ def get_contributing_authors(arg_tuple):
             prev_rev = title_revs[i-1]
             if u'revid' not in curr_rev or u'revid' not in prev_rev:
                 continue
-            edit_dist = edit_distance(title_object, prev_rev[u'revid'], curr_rev[u'revid'])
+            edit_dist = distances[(prev_rev[u'revid'], curr_rev[u'revid'])]
 
-        non_author_revs_comps = [(title_revs[j-1], title_revs[j]) for j in range(i+1, len(title_revs[i+1:i+11]))
-                                 if title_revs[j].get(u'user', u'') != curr_rev.get(u'user')]
-        
-        avg_edit_qty = (sum(map(lambda x: edit_quality(title_object, x[0], x[1]), non_author_revs_comps))
+        avg_edit_qty = (sum(map(lambda x: edit_quality(distances, x[0], x[1]), non_author_revs_comps))
                         / max(1, len(set([non_author_rev_cmp[1].get(u'user', u'') for non_author_rev_cmp in
                                           non_author_revs_comps]))))
         if avg_edit_qty == 0:
             avg_edit_qty = smoothing
         curr_rev[u'edit_longevity'] = avg_edit_qty * edit_dist
 
-    authors = filter(lambda x: x[u'userid'] != 0 and x[u'user'] != u'',
-                     dict([(title_rev.get(u'userid', 0),
-                            {u'userid': title_rev.get(u'userid', 0), u'user': title_rev.get(u'user', u'')}
-                            ) for title_rev in title_revs]).values()
-                     )
+    return doc_id, top_contributing_authors(title_revs)
 
-    for author in authors:
-        author[u'contribs'] = sum([title_rev[u'edit_longevity'] for title_rev in title_revs
-                                  if title_rev.get(u'userid', 0) == author.get(u'userid', 0)
-                                  and u'edit_longevity' in title_rev and title_rev[u'edit_longevity'] > 0])
 
-    authors = filter(lambda x: x.get(u'contribs', 0) > 0, authors)
+def top_contributing_authors(title_revs):
+    """
+    Groups positive edit longevity by author in one pass over the revisions, then keeps everyone
+    at or above minimum_contribution_pct, topped up to minimum_authors with the next best
+    """
+    global minimum_authors, minimum_contribution_pct
+    names, contribs = {}, {}
+    for title_rev in title_revs:
+        userid = title_rev.get(u'userid', 0)
+        names[userid] = title_rev.get(u'user', u'')  # an author goes by the name on their latest revision
+        if title_rev.get(u'edit_longevity', 0) > 0:
+            contribs[userid] = contribs.get(userid, 0) + title_rev[u'edit_longevity']
+
+    authors = [{u'userid': userid, u'user': user, u'contribs': contribs[userid]}
+               for userid, user in names.items() if userid != 0 and user != u'' and userid in contribs]
 
     all_contribs_sum = sum([a[u'contribs'] for a in authors])
 
+    above_minimum = 0
     for author in authors:
         author[u'contrib_pct'] = author[u'contribs']/all_contribs_sum
+        above_minimum += author[u'contrib_pct'] >= minimum_contribution_pct
 
-    for author in sorted(authors, key=lambda x: x[u'contrib_pct'], reverse=True):
-        if u'user' not in author:
-            continue
-        if author[u'contrib_pct'] < minimum_contribution_pct and len(top_authors) >= minimum_authors:
-            break
-        top_authors += [author]
-    return doc_id, top_authors
+    return heapq.nlargest(max(above_minimum, minimum_authors), authors, key=lambda x: x[u'contrib_pct'])
 
 
 def links_for_page(title_object):
@@ -241,14 +592,11 @@ def links_for_page(title_object):
               u'prop': u'links', u'pllimit': 500, u'format': u'json'}
     links = []
     while True:
-        resp = requests.get(api_url, params=params)
         try:
-            response = resp.json()
+            response = session.get_json(api_url, params=params)
         except ValueError as e:
             print e, traceback.format_exc()
-            print resp.content
-            return links
-        resp.close()
+            break
         response_links = response.get(u'query', {}).get(u'pages', {0: {}}).values()[0].get(u'links', [])
         links += [link[u'title'] for link in response_links]
         query_continue = response.get(u'query-continue', {}).get(u'links', {}).get(u'plcontinue')
@@ -259,42 +607,122 @@ def links_for_page(title_object):
     return title_string, links
 
 
-def get_pagerank(args, all_titles):
-    pool = multiprocessing.Pool(processes=args.processes)
-    r = pool.map_async(links_for_page, all_titles)
-    r.wait()
-    all_links = r.get()
-    all_title_strings = list(set([to_string for response in all_links for to_string in response[1]]
-                                 + [obj[u'title'] for obj in all_titles]))
-
-    wiki_graph = digraph()
-    wiki_graph.add_nodes(all_title_strings)  # to prevent missing node_neighbors table
-    for title_object in all_titles:
-        for target in links_for_page(title_object)[1]:
-            try:
-                wiki_graph.add_edge((title_object[u'title'], target))
-            except AdditionError:
-                pass
-
-    return pagerank(wiki_graph)
-
-
-def author_centrality(titles_to_authors):
-    author_graph = digraph()
-    author_graph.add_nodes(map(lambda x: u"title_%s" % x, titles_to_authors.keys()))
-    author_graph.add_nodes(list(set([u'author_%s' % author[u'user']
-                                     for authors in titles_to_authors.values()
-                                     for author in authors])))
+def links_for_title_range(title_range):
+    """
+    [(title, links)] for every page from one title through another, inclusive, using allpages as a
+    generator for prop=links. Links for the whole range share each response, so a range of hundreds
+    of pages takes a handful of requests: plcontinue is followed until this batch of pages runs out of
+    links, and only then does gapfrom move the generator on to the next batch.
+    """
+    global api_url, link_batch_size
+    first_title, last_title = title_range
+    params = {u'action': u'query', u'generator': u'allpages', u'gapfrom': first_title.encode(u'utf8'),
+              u'gapto': last_title.encode(u'utf8'), u'gaplimit': link_batch_size,
+              u'gapfilterredir': u'nonredirects', u'prop': u'links', u'plnamespace': 0, u'pllimit': 500,
+              u'format': u'json'}
+    links = {}
+    while True:
+        try:
+            response = session.get_json(api_url, params=params)
+        except ValueError as e:
+            print e, traceback.format_exc()
+            break
+        for page in response.get(u'query', {}).get(u'pages', {}).values():
+            links.setdefault(page[u'title'], []).extend([link[u'title'] for link in page.get(u'links', [])])
+        query_continue = response.get(u'query-continue', {})
+        if u'links' in query_continue:
+            params.update(query_continue[u'links'])
+        elif u'allpages' in query_continue:
+            params.pop(u'plcontinue', None)
+            params.update(dict([(name, value.encode(u'utf8') if isinstance(value, unicode) else value)
+                                for name, value in query_continue[u'allpages'].items()]))
+        else:
+            break
+    return links.items()
+
+
+def title_ranges(all_titles):
+    # all_titles is in the API's own order, so each slice of it is exactly the pages between its ends
+    global link_batch_size
+    for i in range(0, len(all_titles), link_batch_size):
+        batch = all_titles[i:i+link_batch_size]
+        yield batch[0][u'title'], batch[-1][u'title']
+
+
+def iter_page_links(all_titles):
+    """
+    Yields (title, links) for every page, link_batch_size pages to a query, or one page at a time if that's 1
+    """
+    global fetch_engine, link_batch_size
+    if link_batch_size > 1:
+        for range_links in fetch_engine.imap_unordered(links_for_title_range, title_ranges(all_titles)):
+            for title_links in range_links:
+                yield title_links
+    else:
+        for title_links in fetch_engine.imap_unordered(links_for_page, all_titles):
+            yield title_links
+
+
+def get_link_graph(all_titles):
+    """
+    (titles, CSRGraph) of the wiki's links, each page's links fetched once and streamed straight in
+    as integer edges; linked-to titles that weren't enumerated, like redlinks, are nodes too
+    """
+    builder = graph.GraphBuilder()
+    builder.add_nodes([title_object[u'title'] for title_object in all_titles])
+    for title_string, links in iter_page_links(all_titles):
+        builder.add_links(title_string, links)
+    return builder.names, builder.build()
+
+
+def get_saved_link_graph(args, all_titles):
+    """
+    (titles, CSRGraph) of the wiki's links. The graph is saved with the wiki's state each time it's
+    harvested; with args.reuse_link_graph, the saved one is memory-mapped instead, without touching the API.
+    """
+    links_dir = state_path(args, u'links')
+    if args.reuse_link_graph and graph.CSRGraph.saved_in(links_dir):
+        titles, link_graph = graph.CSRGraph.load(links_dir, mmap_mode=u'r')
+        print u"Loaded %d links between %d pages from %s" % (link_graph.num_edges(), len(titles), links_dir)
+        return titles, link_graph
+    titles, link_graph = get_link_graph(all_titles)
+    replace_directory(links_dir, lambda directory: link_graph.save(directory, titles))
+    return titles, link_graph
 
-    for title in titles_to_authors:
-        for author in titles_to_authors[title]:
-            try:
-                author_graph.add_edge((u'title_%s' % title, u'author_%s' % author[u'user']))
-            except AdditionError:
-                pass
 
-    centralities = dict([('_'.join(item[0].split('_')[1:]), item[1])
-                         for item in pagerank(author_graph).items() if item[0].startswith(u'author_')])
+def get_pagerank(args, all_titles):
+    """
+    PageRank by title, starting from the ranks the last run for this wiki saved
+    """
+    titles, link_graph = get_saved_link_graph(args, all_titles)
+    ranks_dir = state_path(args, u'pagerank')
+    previous = graph.load_ranks(ranks_dir)
+    initial = graph.warm_start(titles, previous, 1.0 / max(1, len(titles))) if previous else None
+    ranks, iterations, residual = graph.pagerank(link_graph, initial=initial)
+    print u"PageRank: %d iterations, residual %.2e, warm-started from %d of %d pages" % (
+        iterations, residual, len([title for title in titles if title in previous]), len(titles))
+    replace_directory(ranks_dir, lambda directory: graph.save_ranks(directory, titles, ranks))
+    return dict(zip(titles, ranks.tolist()))
+
+
+def author_centrality(titles_to_authors, ranks_dir=None):
+    """
+    Min-max scaled centrality of each author. If ranks_dir is given, it starts from the ranks saved
+    there by the last run and saves this run's over them.
+    """
+    builder = graph.BipartiteBuilder()
+    for authors in titles_to_authors.values():
+        builder.add_page([author[u'user'] for author in authors])
+
+    previous = graph.load_ranks(ranks_dir) if ranks_dir is not None else {}
+    ranks, iterations, residual = graph.author_centrality(builder, previous=previous)
+    print u"Author centrality: %d iterations, residual %.2e, warm-started from %d of %d authors" % (
+        iterations, residual, len([name for name in builder.author_names if name in previous]),
+        len(builder.author_names))
+    if ranks_dir is not None:
+        replace_directory(ranks_dir, lambda directory: graph.save_ranks(directory, builder.author_names, ranks))
+
+    centralities = dict(zip(builder.author_names, ranks.tolist()))
 
     centrality_scaler = MinMaxScaler(centralities.values())
 
@@ -302,16 +730,38 @@ def author_centrality(titles_to_authors):
                  for cent_author, cent_val in centralities.items()])
 
 
-def get_title_top_authors(args, all_titles, all_revisions):
-    pool = multiprocessing.Pool(processes=args.processes)
-    title_top_authors = {}
-    r = pool.map_async(get_contributing_authors_safe,
-                       [(title_obj, all_revisions[title_obj[u'title']]) for title_obj in all_titles],
-                       callback=title_top_authors.update)
-    r.wait()
+def get_title_top_authors(args, revision_store, checkpoint):
+    """
+    Scaled top authors for every page. Each page's unscaled authors are logged to the checkpoint as they
+    come in, and pages already logged there -- by a run that died partway through -- aren't scored again.
+    """
+    global wiki_id
+    authors_log = checkpoint.log(u'authors')
+    title_top_authors = dict(authors_log.read())
+    page_indices = [i for i in range(revision_store.num_pages())
+                    if u'%s_%s' % (wiki_id, revision_store.pageids[i]) not in title_top_authors]
+    # a run killed outright never gets to remove its copy of the store, so the next one does
+    for leftover in glob.glob(checkpoint.path(u'revisions_%s_*' % args.wiki_id)):
+        shutil.rmtree(leftover, ignore_errors=True)
+    if len(page_indices) > 0:
+        # workers read revisions from a memory-mapped copy of the store, so tasks are just page indices; those
+        # cost next to nothing to send, so chunks stay small enough that a slow page can't strand a worker's queue
+        store_path = tempfile.mkdtemp(prefix=u'revisions_%s_' % args.wiki_id, dir=checkpoint.directory)
+        try:
+            revision_store.save(store_path)
+            pool = get_pool(args, revision_store_path=store_path)
+            chunksize = args.task_chunk_size or max(1, min(64, len(page_indices) / (args.processes * 16)))
+            for doc_id, authors in pool.imap_unordered(get_page_authors_safe, page_indices, chunksize=chunksize):
+                title_top_authors[doc_id] = authors
+                authors_log.append([doc_id, authors])
+            authors_log.close()
+            pool.close()
+            pool.join()
+            revision_store.load_scores(store_path)
+        finally:
+            shutil.rmtree(store_path, ignore_errors=True)
     if len(title_top_authors) == 0:
         print u"No title top authors for wiki", args.wiki_id
-        print r.get()
         sys.exit(1)
     
     contribs_scaler = MinMaxScaler([author[u'contribs']
@@ -327,10 +777,91 @@ def get_title_top_authors(args, all_titles, all_revisions):
     return scaled_title_top_authors
 
 
-def get_pagerank_dict(all_titles):
+def state_path(args, name):
+    # everything kept about a wiki between runs sits together, apart for each diff mode
+    return os.path.join(args.state_dir, edit_distance_store_key(), name)
+
+
+def get_revision_store(args, checkpoint):
+    """
+    (revision store, title objects in the API's order): every page's revisions, merged onto what the wiki's
+    saved state already has unless args.incremental is off. Each page is logged to the checkpoint as it's
+    fetched, and the finished store saved there, so a resumed run only fetches what it hadn't yet.
+    """
+    global known_revisions
+    store_checkpoint = checkpoint.path(u'revisions')
+    if checkpoint.done(u'revisions'):
+        revision_store = RevisionStore.load(store_checkpoint, mmap_mode=u'r')
+        print u"Resuming with %d pages of revisions from %s" % (revision_store.num_pages(), store_checkpoint)
+        return revision_store, checkpoint.read_json(u'titles.json')
+
+    # pick up from the revisions and longevity an earlier run left behind, if any
+    state_dir = state_path(args, u'revisions')
+    previous_store = None
+    if args.incremental and RevisionStore.saved_in(state_dir):
+        previous_store = RevisionStore.load(state_dir, mmap_mode=u'r')
+        known_revisions = dict([(int(previous_store.pageids[i]), previous_store.last_revid(i))
+                                for i in range(previous_store.num_pages())
+                                if previous_store.last_revid(i) is not None])
+        print u"Picking up %d pages from %s" % (len(known_revisions), state_dir)
+
+    builder = RevisionStoreBuilder()
+    fetched_pageids = set()
+
+    def add_page(title, pageid, revisions):
+        fetched_pageids.add(pageid)
+        if pageid in known_revisions:
+            previous_index = previous_store.pageid_index(pageid)
+            builder.add_page(title, pageid, previous_store.page_revisions(previous_index) + revisions,
+                             scored=int(previous_store.scored[previous_index]))
+        else:
+            builder.add_page(title, pageid, revisions)
+
+    revisions_log = checkpoint.log(u'revisions')
+    new_revisions = 0
+    for pageid, title, revisions in revisions_log.read():
+        add_page(title, pageid, revisions)
+        new_revisions += len(revisions)
+
+    # the enum itself is serial, but each batch goes straight on to the revision stage
+    all_titles = []
+    title_pageids = {}
+
+    def enumerate_titles():
+        if checkpoint.done(u'titles'):
+            title_batches = [checkpoint.read_json(u'titles.json')]
+        else:
+            title_batches = iter_title_batches()
+        for title_batch in title_batches:
+            all_titles.extend(title_batch)
+            title_pageids.update([(title_object[u'title'], title_object[u'pageid']) for title_object in title_batch])
+            yield [title_object for title_object in title_batch if title_object[u'pageid'] not in fetched_pageids]
+        if not checkpoint.done(u'titles'):
+            checkpoint.write_json(u'titles.json', all_titles)
+            checkpoint.mark_done(u'titles')
+
+    for title, revisions in iter_all_revisions(enumerate_titles()):
+        add_page(title, title_pageids[title], revisions)
+        revisions_log.append([title_pageids[title], title, revisions])
+        new_revisions += len(revisions)
+    revisions_log.close()
+    revision_store = builder.build()
+    print u"Got %d titles" % len(all_titles)
+    print u"%d Revisions" % len(revision_store)
+    if len(known_revisions) > 0:
+        print u"%d of them new since the last run" % new_revisions
+    print u"Revision store holds %.1f bytes/revision, vs. %.1f as JSON dicts" % (
+        float(revision_store.nbytes()) / max(1, len(revision_store)), builder.dict_bytes_per_revision())
+
+    replace_directory(store_checkpoint, revision_store.save)
+    checkpoint.mark_done(u'revisions')
+    return revision_store, all_titles
+
+
+def get_pagerank_dict(args, all_titles):
     title_to_pageid = dict([(title_object[u'title'], title_object[u'pageid']) for title_object in all_titles])
     pr = dict([(u'%s_%s' % (str(wiki_id), title_to_pageid[title]), pagerank)
-               for title, pagerank in get_pagerank(all_titles).items() if title in title_to_pageid])
+               for title, pagerank in get_pagerank(args, all_titles).items() if title in title_to_pageid])
     return pr
 
 
@@ -345,15 +876,80 @@ def get_args():
                         help=u'The ID of the wiki you want to operate on')
     parser.add_argument(u'--processes', dest=u'processes', action=u'store', type=int, default=default_cpus,
                         help=u'Number of processes you want to run at once')
+    parser.add_argument(u'--http-pool-size', dest=u'http_pool_size', action=u'store', type=int, default=10,
+                        help=u'Number of keep-alive connections each worker holds open to the API')
+    parser.add_argument(u'--revision-batch-size', dest=u'revision_batch_size', action=u'store', type=int,
+                        default=50, help=u'Number of pages to pack into each revision query; 1 queries per page')
+    parser.add_argument(u'--link-batch-size', dest=u'link_batch_size', action=u'store', type=int, default=500,
+                        help=u'Number of pages to harvest links for in each query; 1 queries per page')
+    parser.add_argument(u'--max-request-rate', dest=u'max_request_rate', action=u'store', type=float, default=400,
+                        help=u'Ceiling on API requests per second against this wiki, across all workers; the default '
+                             u'is about what 64 processes sleeping 25ms after each request used to manage')
+    parser.add_argument(u'--cache-path', dest=u'cache_path', action=u'store',
+                        default=os.path.expanduser(u'~/.wikia_authority/api_cache.sqlite'),
+                        help=u'SQLite file to keep API responses that never change, such as diffs, in across runs')
+    parser.add_argument(u'--cache-max-mb', dest=u'cache_max_mb', action=u'store', type=int, default=10240,
+                        help=u'Size cap on the response cache, past which least recently used entries go')
+    parser.add_argument(u'--no-cache', dest=u'use_cache', action=u'store_false', default=True,
+                        help=u'Always go to the API')
+    parser.add_argument(u'--distance-store-path', dest=u'distance_store_path', action=u'store',
+                        default=os.path.expanduser(u'~/.wikia_authority/edit_distances.sqlite'),
+                        help=u'SQLite file that keeps edit distances across workers and runs')
+    parser.add_argument(u'--diff-mode', dest=u'diff_mode', action=u'store', choices=[u'api', u'local'],
+                        default=u'api', help=u'Score edits from the API\'s rendered diffs, or diff fetched '
+                                             u'revision text locally with one request per batch of revisions')
+    parser.add_argument(u'--fetch-concurrency', dest=u'fetch_concurrency', action=u'store', type=int, default=256,
+                        help=u'Number of API requests to keep in flight at once')
+    parser.add_argument(u'--state-dir', dest=u'state_dir', action=u'store',
+                        default=os.path.expanduser(u'~/.wikia_authority/state'),
+                        help=u'Directory to keep each wiki\'s revisions and edit longevity in between runs')
+    parser.add_argument(u'--pagerank', dest=u'pagerank', action=u'store_true', default=False,
+                        help=u'Harvest the wiki\'s links and write each page\'s PageRank too')
+    parser.add_argument(u'--reuse-link-graph', dest=u'reuse_link_graph', action=u'store_true', default=False,
+                        help=u'Rank pages on the link graph saved by the last run instead of harvesting it again')
+    parser.add_argument(u'--full-refresh', dest=u'incremental', action=u'store_false', default=True,
+                        help=u'Ignore the saved state and fetch, score and write everything from scratch')
+    parser.add_argument(u'--checkpoint-dir', dest=u'checkpoint_dir', action=u'store',
+                        default=os.path.expanduser(u'~/.wikia_authority/checkpoints'),
+                        help=u'Directory to checkpoint each stage of a run in, for --resume')
+    parser.add_argument(u'--resume', dest=u'resume', action=u'store_true', default=False,
+                        help=u'Skip the stages, and pages within a stage, that the last run for this wiki finished')
+    parser.add_argument(u'--storage', dest=u'storage', action=u'store', default=u's3://nlp-data',
+                        help=u'Where to write results: s3://bucket, sqlite:///path/to/results.sqlite, or a directory')
+    parser.add_argument(u'--page-bundle', dest=u'page_bundle', action=u'store_true', default=False,
+                        help=u'Write every page\'s authors as one indexed bundle per wiki instead of a key per page')
+    parser.add_argument(u'--gzip-wiki-keys', dest=u'gzip_wiki_keys', action=u'store_true', default=False,
+                        help=u'Write the wiki-wide results as gzipped JSON under .gz keys too, next to the plain ones')
+    parser.add_argument(u'--upload-batch-size', dest=u'upload_batch_size', action=u'store', type=int, default=100,
+                        help=u'Number of page results to hand a worker to write at a time')
+    parser.add_argument(u'--upload-concurrency', dest=u'upload_concurrency', action=u'store', type=int, default=8,
+                        help=u'Number of writes each worker keeps in flight at once')
+    parser.add_argument(u'--task-chunk-size', dest=u'task_chunk_size', action=u'store', type=int, default=0,
+                        help=u'Pages handed to a worker at a time when scoring authors; 0 sizes chunks by page count')
     return parser.parse_args()
 
 
 def main():
-    global minimum_authors, minimum_contribution_pct, smoothing, wiki_id, api_url, edit_distance_memoization_cache
+    global minimum_authors, minimum_contribution_pct, smoothing, wiki_id, api_url, edit_distance_store
+    global connection_stats, fetch_engine, revision_batch_size, rate_limiter, response_cache, diff_mode
+    global link_batch_size, result_store
 
     args = get_args()
 
-    edit_distance_memoization_cache = {}
+    revision_batch_size = args.revision_batch_size
+    link_batch_size = args.link_batch_size
+    diff_mode = args.diff_mode
+
+    connection_stats = session.connection_counters()
+    rate_limiter = RateLimiter(max_rate=args.max_request_rate)
+    if args.use_cache:
+        response_cache = ResponseCache(args.cache_path, max_bytes=args.cache_max_mb * 1024 ** 2)
+    session.init_session(pool_size=max(args.http_pool_size, args.fetch_concurrency), counters=connection_stats,
+                         limiter=rate_limiter, cache=response_cache)
+    fetch_engine = FetchEngine(concurrency=args.fetch_concurrency)
+
+    edit_distance_store = EditDistanceStore(args.distance_store_path)
+    result_store = open_result_store(args.storage, concurrency=args.upload_concurrency)
 
     smoothing = 0.001
 
@@ -366,7 +962,7 @@ def main():
     minimum_contribution_pct = 0.01
 
     # get wiki info
-    resp = requests.get(u'http://www.wikia.com/api/v1/Wikis/Details', params={u'ids': wiki_id})
+    resp = session.get(u'http://www.wikia.com/api/v1/Wikis/Details', params={u'ids': wiki_id})
     items = resp.json()['items']
     if wiki_id not in items:
         print u"Wiki doesn't exist?"
@@ -376,23 +972,26 @@ def main():
     print wiki_data[u'title'].encode(u'utf8')
     api_url = u'%sapi.php' % wiki_data[u'url']
 
-    # can't be parallelized since it's an enum
-    all_titles = get_all_titles()
-    print u"Got %d titles" % len(all_titles)
-
-    pool = multiprocessing.Pool(processes=args.processes)
+    checkpoint_dir = os.path.join(args.checkpoint_dir, edit_distance_store_key())
+    if not args.resume:
+        Checkpoint(checkpoint_dir).clear()
+    checkpoint = Checkpoint(checkpoint_dir)
 
-    all_revisions = []
-    r = pool.map_async(get_all_revisions, all_titles, callback=all_revisions.extend)
-    r.wait()
-    print u"%d Revisions" % sum([len(revs) for title, revs in all_revisions])
-    all_revisions = dict(all_revisions)
+    revision_store, all_titles = get_revision_store(args, checkpoint)
 
-    title_top_authors = get_title_top_authors(args, all_titles, all_revisions)
+    title_top_authors = get_title_top_authors(args, revision_store, checkpoint)
+    if not checkpoint.done(u'authors'):
+        replace_directory(state_path(args, u'revisions'), revision_store.save)
+        checkpoint.mark_done(u'authors')
 
     print time.time() - start
 
-    centralities = author_centrality(title_top_authors)
+    if checkpoint.done(u'centralities'):
+        centralities = checkpoint.read_json(u'centralities.json')
+    else:
+        centralities = author_centrality(title_top_authors, ranks_dir=state_path(args, u'centrality'))
+        checkpoint.write_json(u'centralities.json', centralities)
+        checkpoint.mark_done(u'centralities')
 
     # this com_qscore_pr, the best metric per Qin and Cunningham
     comqscore_authority = dict([(doc_id,
@@ -402,18 +1001,43 @@ def main():
 
     print u"Got comsqscore, storing data"
 
-    bucket = connect_s3().get_bucket(u'nlp-data')
-    key = bucket.new_key(key_name=u'service_responses/%s/WikiAuthorCentralityService.get' % wiki_id)
-    key.set_contents_from_string(json.dumps(centralities, ensure_ascii=False))
-
-    key = bucket.new_key(key_name=u'service_responses/%s/WikiAuthorityService.get' % wiki_id)
-    key.set_contents_from_string(json.dumps(comqscore_authority, ensure_ascii=False))
-
-    q = pool.map_async(
-        set_page_key,
-        title_top_authors.items()
-    )
-    q.wait()
+    wiki_keys = [(u'service_responses/%s/WikiAuthorCentralityService.get' % wiki_id, centralities),
+                 (u'service_responses/%s/WikiAuthorityService.get' % wiki_id, comqscore_authority)]
+    if args.pagerank:
+        if checkpoint.done(u'pagerank'):
+            pageranks = checkpoint.read_json(u'pagerank.json')
+        else:
+            pageranks = get_pagerank_dict(args, all_titles)
+            checkpoint.write_json(u'pagerank.json', pageranks)
+            checkpoint.mark_done(u'pagerank')
+        wiki_keys.append((u'service_responses/%s/WikiPageRankService.get' % wiki_id, pageranks))
+
+    previous_digests = previous_manifest(args)
+    skipped, saved = 0, 0
+    if not checkpoint.done(u'wiki_keys'):
+        skipped, saved = put_wiki_keys(wiki_keys, checkpoint, previous_digests, gzipped=args.gzip_wiki_keys)
+        checkpoint.mark_done(u'wiki_keys')
+
+    if not args.page_bundle:
+        page_skipped, page_saved = upload_page_keys(args, title_top_authors, checkpoint, previous_digests)
+    elif not checkpoint.done(u'page_bundle'):
+        page_skipped, page_saved = write_page_bundle(title_top_authors, checkpoint, previous_digests)
+        checkpoint.mark_done(u'page_bundle')
+    else:
+        page_skipped, page_saved = 0, 0
+    print u"Skipped %d writes of unchanged results, saving %d bytes" % (skipped + page_skipped, saved + page_saved)
+
+    digests = dict(checkpoint.log(u'uploads').read())
+    if digests != previous_digests:
+        result_store.put(manifest_key(), json.dumps(digests, separators=(',', ':')))
+    checkpoint.clear()
+
+    print (u"HTTP connections opened: %(connections_opened)d, reused: %(connections_reused)d, "
+           u"answered from cache: %(cache_hits)d" % connection_stats.as_dict())
+    print (u"Edit distances: %(memory_hits_pct).1f%% from memory, %(store_hits_pct).1f%% from the store, "
+           u"%(misses_pct).1f%% computed (%(misses)d)" % edit_distance_store.stats())
+    print (u"API request rate settled at %(rate).1f/sec, %(latency).2fs average latency, "
+           u"%(throttled)d requests throttled" % rate_limiter.stats())
 
     print wiki_id, u"finished in", time.time() - start, u"seconds"
 
@@ -422,4 +1046,6 @@ if __name__ == u'__main__':
     try:
         main()
     except Exception as exc:
-        print exc, traceback.format_exc()
\ No newline at end of file
+        print exc, traceback.format_exc()
+        print u"Rerun with --resume to pick up from the last completed stage"
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,419 @@
+"""
+Benchmarks for the authority extraction pipeline. Each subcommand reports wall time and,
+where the network is involved, how many API requests the stage needed.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import api_to_database
+from lxml import html
+from wikia_authority import session
+from wikia_authority.fetch import FetchEngine
+from wikia_authority import worddiff
+from wikia_authority import graph
+from wikia_authority.storage import open_result_store
+from wikia_authority.bundle import write_bundle, PageAuthorityBundle
+from pygraph.classes.digraph import digraph
+from pygraph.algorithms.pagerank import pagerank
+from pygraph.classes.exceptions import AdditionError
+
+
+def init_api(args):
+    counters = session.connection_counters()
+    session.init_session(pool_size=args.fetch_concurrency, counters=counters)
+    api_to_database.api_url = args.api_url
+    api_to_database.fetch_engine = FetchEngine(concurrency=args.fetch_concurrency)
+    return counters
+
+
+def request_count(counters):
+    return counters.get(u'connections_opened') + counters.get(u'connections_reused')
+
+
+def bench_revisions(args):
+    counters = init_api(args)
+    titles = api_to_database.get_all_titles()[:args.pages]
+    print u"Fetching revisions for %d pages" % len(titles)
+    for batch_size in [1, args.batch_size]:
+        api_to_database.revision_batch_size = batch_size
+        before = request_count(counters)
+        start = time.time()
+        all_revisions = list(api_to_database.iter_all_revisions([titles]))
+        print u"batch size %4d: %6d requests, %7d revisions, %.2f seconds" % (
+            batch_size, request_count(counters) - before, sum([len(revs) for title, revs in all_revisions]),
+            time.time() - start)
+
+
+def bench_diffs(args):
+    """
+    Checks local word diffs against the API's rendered ones on consecutive revisions of sample pages
+    """
+    counters = init_api(args)
+    titles = api_to_database.get_all_titles()[:args.pages]
+    all_revisions = dict(api_to_database.iter_all_revisions([titles]))
+    api_to_database.edit_distance_store = None
+    compared, matched, total_difference = 0, 0, 0.0
+    requests_by_mode = {u'api': 0, u'local': 0}
+    seconds_by_mode = {u'api': 0.0, u'local': 0.0}
+    for title_object in titles:
+        revids = [rev[u'revid'] for rev in all_revisions.get(title_object[u'title'], []) if u'revid' in rev]
+        pairs = zip(revids, revids[1:])
+        distances = {}
+        for mode in [u'api', u'local']:
+            api_to_database.diff_mode = mode
+            api_to_database.revision_texts = worddiff.RevisionTextCache(api_to_database.fetch_revision_texts, revids)
+            before, start = request_count(counters), time.time()
+            distances[mode] = [api_to_database.edit_distance(title_object, earlier, later) for earlier, later in pairs]
+            requests_by_mode[mode] += request_count(counters) - before
+            seconds_by_mode[mode] += time.time() - start
+        for api_distance, local_distance in zip(distances[u'api'], distances[u'local']):
+            compared += 1
+            matched += api_distance == local_distance
+            total_difference += abs(api_distance - local_distance)
+    print u"%d revision pairs on %d pages" % (compared, len(titles))
+    print u"exact matches: %d (%.1f%%), mean absolute difference: %.3f" % (
+        matched, 100.0 * matched / max(1, compared), total_difference / max(1, compared))
+    for mode in [u'api', u'local']:
+        print u"%5s diffs: %6d requests, %.2f seconds" % (mode, requests_by_mode[mode], seconds_by_mode[mode])
+
+
+def legacy_edit_distance(diff_html):
+    # edit_distance's scoring as it was before moving to worddiff, kept for comparison
+    diff_dom = html.fromstring(diff_html)
+    deleted = [word for span in diff_dom.cssselect(u'td.diff-deletedline span.diffchange-inline')
+               for word in span.text_content().split(' ')]
+    added = [word for span in diff_dom.cssselect(u'td.diff-addedline span.diffchange-inline')
+             for word in span.text_content().split(' ')]
+    adds = sum([1 for word in added if word not in deleted])
+    deletes = sum([1 for word in deleted if word not in added])
+    moves = sum([1 for word in added if word in deleted])
+    return max([adds, deletes]) - 0.5 * min([adds, deletes]) + moves
+
+
+def synthetic_diff(num_words, vocabulary_size=5000, words_per_line=40):
+    vocabulary = [u'word%d' % i for i in range(vocabulary_size)]
+    rows = []
+    for i in range(0, num_words, words_per_line):
+        line_words = min(words_per_line, num_words - i)
+        cells = []
+        for side in [u'deleted', u'added']:
+            words = [random.choice(vocabulary) for j in range(line_words / 2)]
+            cells.append(u'<td class="diff-%sline"><div>unchanged <span class="diffchange diffchange-inline">%s</span>'
+                         u'</div></td>' % (side, u' '.join(words)))
+        rows.append(u'<tr>%s</tr>' % u''.join(cells))
+    return u'<table class="diff">%s</table>' % u''.join(rows)
+
+
+def bench_scoring(args):
+    """
+    Scoring a rendered diff: cssselect plus list membership vs. precompiled XPath plus hashed sets
+    """
+    legacy_seconds = {}
+    for num_words in args.sizes:
+        diff_html = synthetic_diff(num_words)
+        start = time.time()
+        distance = worddiff.score_words(*worddiff.html_diff_words(diff_html))
+        seconds = time.time() - start
+        if num_words <= args.legacy_max_words:
+            start = time.time()
+            assert legacy_edit_distance(diff_html) == distance
+            legacy_seconds[num_words] = time.time() - start
+            legacy = u'%.4f' % legacy_seconds[num_words]
+        else:
+            # the old scoring is quadratic, so extrapolate from the largest size actually timed
+            measured = max(legacy_seconds)
+            legacy = u'~%.1f (est.)' % (legacy_seconds[measured] * (float(num_words) / measured) ** 2)
+        print u"%7d words: %.4f seconds, previously %s seconds" % (num_words, seconds, legacy)
+
+
+def legacy_top_authors(title_revs, minimum_authors, minimum_contribution_pct):
+    # get_contributing_authors' aggregation as it was before top_contributing_authors, kept for comparison
+    authors = filter(lambda x: x[u'userid'] != 0 and x[u'user'] != u'',
+                     dict([(title_rev.get(u'userid', 0),
+                            {u'userid': title_rev.get(u'userid', 0), u'user': title_rev.get(u'user', u'')}
+                            ) for title_rev in title_revs]).values())
+    for author in authors:
+        author[u'contribs'] = sum([title_rev[u'edit_longevity'] for title_rev in title_revs
+                                  if title_rev.get(u'userid', 0) == author.get(u'userid', 0)
+                                  and u'edit_longevity' in title_rev and title_rev[u'edit_longevity'] > 0])
+    authors = filter(lambda x: x.get(u'contribs', 0) > 0, authors)
+    all_contribs_sum = sum([a[u'contribs'] for a in authors])
+    for author in authors:
+        author[u'contrib_pct'] = author[u'contribs']/all_contribs_sum
+    top_authors = []
+    for author in sorted(authors, key=lambda x: x[u'contrib_pct'], reverse=True):
+        if author[u'contrib_pct'] < minimum_contribution_pct and len(top_authors) >= minimum_authors:
+            break
+        top_authors += [author]
+    return top_authors
+
+
+def synthetic_revisions(num_revisions, num_authors):
+    revisions = []
+    for revid in range(1, num_revisions + 1):
+        userid = random.randint(0, num_authors)
+        revisions.append({u'revid': revid, u'parentid': revid - 1, u'userid': userid, u'user': u'User %d' % userid,
+                          u'edit_longevity': random.choice([-1, 1]) * random.random() * 100})
+    return revisions
+
+
+def bench_authors(args):
+    """
+    Per-page author aggregation and top-author selection on long histories
+    """
+    api_to_database.minimum_authors = 5
+    api_to_database.minimum_contribution_pct = 0.01
+    for num_revisions in args.sizes:
+        title_revs = synthetic_revisions(num_revisions, min(num_revisions / 2, args.max_authors))
+        start = time.time()
+        top_authors = api_to_database.top_contributing_authors(title_revs)
+        seconds = time.time() - start
+        start = time.time()
+        assert legacy_top_authors(title_revs, 5, 0.01) == top_authors
+        print u"%6d revisions: %.4f seconds, previously %.4f seconds" % (num_revisions, seconds, time.time() - start)
+
+
+def synthetic_links(num_edges, links_per_page=20, redlink_pct=0.1):
+    num_pages = max(1, num_edges / links_per_page)
+    links = []
+    for i in range(num_edges):
+        # a few hub pages draw most links, as on a real wiki; the tail past num_pages has no out links
+        target = int(num_pages * (1 + redlink_pct) * random.random() ** 3)
+        links.append((u'Page %d' % random.randint(0, num_pages - 1), u'Page %d' % target))
+    return links
+
+
+def legacy_pagerank(links):
+    # get_pagerank's graph as it was before wikia_authority.graph, kept for comparison
+    wiki_graph = digraph()
+    wiki_graph.add_nodes(list(set([title for link in links for title in link])))
+    for link in links:
+        try:
+            wiki_graph.add_edge(link)
+        except AdditionError:
+            pass
+    return pagerank(wiki_graph)
+
+
+def bench_pagerank(args):
+    """
+    PageRank on integer CSR graphs vs. pygraph on string nodes. pygraph drops the rank of pages
+    without out links, so the comparison runs with dangling redistribution off. Then 1% more links
+    are added, and the new graph ranked from scratch and from the old ranks.
+    """
+    for num_edges in args.sizes:
+        links = synthetic_links(num_edges)
+        start = time.time()
+        builder = graph.GraphBuilder()
+        for source, target in links:
+            builder.add_edge(builder.node_id(source), builder.node_id(target))
+        link_graph = builder.build()
+        build_seconds = time.time() - start
+        start = time.time()
+        ranks = graph.pagerank(link_graph, dangling=False)[0]
+        seconds = time.time() - start
+        if num_edges <= args.legacy_max_edges:
+            start = time.time()
+            legacy_ranks = legacy_pagerank(links)
+            legacy = u'%.3f' % (time.time() - start)
+            difference = max([abs(legacy_ranks[name] - rank) / legacy_ranks[name]
+                              for name, rank in zip(builder.names, ranks.tolist())])
+            assert difference < 0.001
+            legacy += u', largest relative difference %.2e' % difference
+        else:
+            legacy = u'not run'
+        print u"%8d edges, %7d nodes: %.3f seconds to build, %.3f to rank; pygraph %s" % (
+            link_graph.num_edges(), link_graph.num_nodes(), build_seconds, seconds, legacy)
+
+        previous = dict(zip(builder.names, graph.pagerank(link_graph)[0].tolist()))
+        for source, target in synthetic_links(num_edges)[:max(1, num_edges / 100)]:
+            builder.add_edge(builder.node_id(source), builder.node_id(target))
+        changed_graph = builder.build()
+        cold_iterations = graph.pagerank(changed_graph)[1]
+        start = time.time()
+        initial = graph.warm_start(builder.names, previous, 1.0 / len(builder.names))
+        warm_iterations = graph.pagerank(changed_graph, initial=initial)[1]
+        print u"%8s after 1%% more links: %d iterations from scratch, %d warm-started (%.3f seconds)" % (
+            u'', cold_iterations, warm_iterations, time.time() - start)
+
+
+def synthetic_top_authors(num_edges, authors_per_page=5, num_authors=50000):
+    titles_to_authors = {}
+    for page in range(num_edges / authors_per_page):
+        titles_to_authors[u'123_%d' % page] = [{u'user': u'User_%d' % random.randint(0, num_authors)}
+                                               for i in range(authors_per_page)]
+    return titles_to_authors
+
+
+def legacy_author_centrality(titles_to_authors):
+    # author_centrality's graph as it was before the bipartite engine, kept for comparison
+    author_graph = digraph()
+    author_graph.add_nodes(map(lambda x: u"title_%s" % x, titles_to_authors.keys()))
+    author_graph.add_nodes(list(set([u'author_%s' % author[u'user']
+                                     for authors in titles_to_authors.values()
+                                     for author in authors])))
+    for title in titles_to_authors:
+        for author in titles_to_authors[title]:
+            try:
+                author_graph.add_edge((u'title_%s' % title, u'author_%s' % author[u'user']))
+            except AdditionError:
+                pass
+    return dict([('_'.join(item[0].split('_')[1:]), item[1])
+                 for item in pagerank(author_graph).items() if item[0].startswith(u'author_')])
+
+
+def bench_centrality(args):
+    """
+    Author centrality on the integer bipartite engine vs. a pygraph digraph with prefixed string nodes
+    """
+    for num_edges in args.sizes:
+        titles_to_authors = synthetic_top_authors(num_edges, num_authors=args.max_authors)
+        start = time.time()
+        builder = graph.BipartiteBuilder()
+        for authors in titles_to_authors.values():
+            builder.add_page([author[u'user'] for author in authors])
+        centralities = dict(zip(builder.author_names, graph.author_centrality(builder)[0].tolist()))
+        seconds = time.time() - start
+        if num_edges <= args.legacy_max_edges:
+            start = time.time()
+            legacy_centralities = legacy_author_centrality(titles_to_authors)
+            legacy = u'%.3f' % (time.time() - start)
+            assert sorted(legacy_centralities) == sorted(centralities)
+            difference = max([abs(legacy_centralities[name] - rank) / legacy_centralities[name]
+                              for name, rank in centralities.items()])
+            assert difference < 0.000001
+            legacy += u', largest relative difference %.2e' % difference
+        else:
+            legacy = u'not run'
+        print u"%8d page-author edges, %6d authors: %.3f seconds; pygraph %s" % (
+            num_edges, len(centralities), seconds, legacy)
+
+
+def bench_uploads(args):
+    """
+    Keys/sec writing synthetic page results one at a time vs. in concurrent batches, to --storage or a scratch directory
+    """
+    root = None
+    if args.storage is None:
+        root = tempfile.mkdtemp(prefix=u'upload_bench_')
+    try:
+        items = [(u'/benchmark/%d/PageAuthorityService.get' % i,
+                  json.dumps([{u'userid': i, u'user': u'User %d' % i, u'contribs': random.random()}] * 5))
+                 for i in range(args.keys)]
+        for concurrency in args.concurrency:
+            store = open_result_store(args.storage or root, concurrency=concurrency)
+            start = time.time()
+            if concurrency == 1:
+                for key, body in items:
+                    store.put(key, body)
+            else:
+                for i in range(0, len(items), args.batch_size):
+                    store.put_many(items[i:i+args.batch_size])
+            seconds = time.time() - start
+            print u"%3d writes in flight: %.1f keys/sec" % (concurrency, len(items) / seconds)
+    finally:
+        if root is not None:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_bundle(args):
+    """
+    Size and lookup speed of one page authority bundle vs. the per-page keys it stands in for
+    """
+    directory = tempfile.mkdtemp(prefix=u'bundle_bench_')
+    try:
+        for pages in args.sizes:
+            page_authors = dict([(doc_id, [dict(author, userid=random.randint(0, 10 ** 6), contribs=random.random())
+                                           for author in authors])
+                                 for doc_id, authors in synthetic_top_authors(pages * 5).items()])
+            key_bytes = sum([len(json.dumps(authors, ensure_ascii=False)) for authors in page_authors.values()])
+            path = u'%s/%d.bundle' % (directory, pages)
+            start = time.time()
+            with open(path, u'wb') as bundle_file:
+                write_bundle(bundle_file, page_authors.items())
+            seconds = time.time() - start
+            bundle = PageAuthorityBundle.open(path)
+            doc_ids = random.sample(page_authors.keys(), min(args.lookups, len(page_authors)))
+            start = time.time()
+            for doc_id in doc_ids:
+                bundle.get(doc_id)
+            lookup_seconds = time.time() - start
+            print u"%8d pages: %d keys of %d bytes, or one %d byte bundle written in %.3f seconds; %.0f lookups/sec" % (
+                pages, len(page_authors), key_bytes, os.path.getsize(path), seconds,
+                len(doc_ids) / max(lookup_seconds, 0.000001))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description=u'Benchmark stages of authority extraction.')
+    parser.add_argument(u'--api-url', dest=u'api_url', action=u'store', default=u'http://muppet.wikia.com/api.php',
+                        help=u'MediaWiki api.php to run network benchmarks against')
+    parser.add_argument(u'--fetch-concurrency', dest=u'fetch_concurrency', action=u'store', type=int, default=32,
+                        help=u'Number of API requests to keep in flight at once')
+    subparsers = parser.add_subparsers()
+
+    revisions = subparsers.add_parser(u'revisions', help=u'Per-page vs. batched revision queries')
+    revisions.add_argument(u'--pages', dest=u'pages', action=u'store', type=int, default=2000)
+    revisions.add_argument(u'--batch-size', dest=u'batch_size', action=u'store', type=int, default=50)
+    revisions.set_defaults(func=bench_revisions)
+
+    diffs = subparsers.add_parser(u'diffs', help=u'Local word diffs vs. the API\'s rendered diffs')
+    diffs.add_argument(u'--pages', dest=u'pages', action=u'store', type=int, default=200)
+    diffs.set_defaults(func=bench_diffs)
+
+    scoring = subparsers.add_parser(u'scoring', help=u'Scoring rendered diffs of increasing size')
+    scoring.add_argument(u'--sizes', dest=u'sizes', action=u'store', type=int, nargs=u'+',
+                         default=[1000, 10000, 100000])
+    scoring.add_argument(u'--legacy-max-words', dest=u'legacy_max_words', action=u'store', type=int, default=10000,
+                         help=u'Largest diff to time the old quadratic scoring on')
+    scoring.set_defaults(func=bench_scoring)
+
+    authors = subparsers.add_parser(u'authors', help=u'Author aggregation on pages with long histories')
+    authors.add_argument(u'--sizes', dest=u'sizes', action=u'store', type=int, nargs=u'+', default=[1000, 10000, 50000])
+    authors.add_argument(u'--max-authors', dest=u'max_authors', action=u'store', type=int, default=5000)
+    authors.set_defaults(func=bench_authors)
+
+    ranks = subparsers.add_parser(u'pagerank', help=u'PageRank on link graphs of increasing size')
+    ranks.add_argument(u'--sizes', dest=u'sizes', action=u'store', type=int, nargs=u'+',
+                       default=[10000, 100000, 1000000])
+    ranks.add_argument(u'--legacy-max-edges', dest=u'legacy_max_edges', action=u'store', type=int, default=100000,
+                       help=u'Largest graph to run pygraph\'s pagerank on')
+    ranks.set_defaults(func=bench_pagerank)
+
+    centrality = subparsers.add_parser(u'centrality', help=u'Author centrality on growing page-author graphs')
+    centrality.add_argument(u'--sizes', dest=u'sizes', action=u'store', type=int, nargs=u'+',
+                            default=[10000, 100000, 1000000])
+    centrality.add_argument(u'--max-authors', dest=u'max_authors', action=u'store', type=int, default=50000)
+    centrality.add_argument(u'--legacy-max-edges', dest=u'legacy_max_edges', action=u'store', type=int,
+                            default=100000, help=u'Largest graph to run the pygraph version on')
+    centrality.set_defaults(func=bench_centrality)
+
+    uploads = subparsers.add_parser(u'uploads', help=u'Writing page results through a result store')
+    uploads.add_argument(u'--keys', dest=u'keys', action=u'store', type=int, default=5000)
+    uploads.add_argument(u'--batch-size', dest=u'batch_size', action=u'store', type=int, default=100)
+    uploads.add_argument(u'--concurrency', dest=u'concurrency', action=u'store', type=int, nargs=u'+',
+                         default=[1, 8, 32])
+    uploads.add_argument(u'--storage', dest=u'storage', action=u'store', default=None,
+                         help=u's3://bucket, sqlite:///path/to/results.sqlite or a directory to write to; '
+                              u'a scratch directory if not given')
+    uploads.set_defaults(func=bench_uploads)
+
+    bundle = subparsers.add_parser(u'bundle', help=u'One page authority bundle vs. a key per page')
+    bundle.add_argument(u'--sizes', dest=u'sizes', action=u'store', type=int, nargs=u'+',
+                        default=[10000, 100000, 200000])
+    bundle.add_argument(u'--lookups', dest=u'lookups', action=u'store', type=int, default=10000,
+                        help=u'Random pages to look up in each bundle')
+    bundle.set_defaults(func=bench_bundle)
+
+    return parser.parse_args()
+
+
+if __name__ == u'__main__':
+    args = get_args()
+    args.func(args)
@@ -5,6 +5,7 @@ from argparse import ArgumentParser, FileType
 from boto import connect_s3
 from boto.ec2 import connect_to_region
 from boto.utils import get_instance_metadata
+from wikia_authority.storage import open_result_store
 
 
 class Unbuffered:
@@ -28,16 +29,22 @@ def get_args():
     ap.add_argument('--die-on-complete', dest='die_on_complete', action='store_true', default=False)
     ap.add_argument('--emit-events', dest='emit_events', action='store_true', default=False)
     ap.add_argument('--event-size', dest='event_size', type=int, default=10)
+    ap.add_argument('--max-request-rate', dest='max_request_rate', type=float, default=400,
+                    help='Ceiling on API requests per second against each wiki')
+    ap.add_argument('--storage', dest='storage', default='s3://nlp-data',
+                    help='Where results and events are written: s3://bucket, sqlite:///path/to/results.sqlite, '
+                         'or a directory')
     return ap.parse_args()
 
 
 def main():
     sys.stdout = Unbuffered(sys.stdout)
-    bucket = connect_s3().get_bucket('nlp-data')
     failed_events = open('/var/log/authority_failed.txt', 'a')
 
     args = get_args()
+    store = open_result_store(args.storage)
     if args.s3file:
+        bucket = connect_s3().get_bucket('nlp-data')
         fname = args.s3file.split('/')[-1]
         bucket.get_key(args.s3file).get_file(open(fname, 'w'))
         fl = open(fname, 'r')
@@ -47,26 +54,34 @@ def main():
     events = []
     for line in fl:
         wid = line.strip()
-        key = bucket.get_key(key_name='service_responses/%s/WikiAuthorityService.get' % wid)
-        if (not args.overwrite) and (key is not None and key.exists()):
+        if (not args.overwrite) and store.exists('service_responses/%s/WikiAuthorityService.get' % wid):
             print "Key exists for", wid
             continue
         print "Wiki ", wid
         try:
-            print subprocess.call("python api_to_database.py --wiki-id=%s --processes=64" % wid, shell=True)
-            events.append(wid)
+            command = ("python api_to_database.py --wiki-id=%s --fetch-concurrency=256 --max-request-rate=%s "
+                       "--storage=%s" % (wid, args.max_request_rate, args.storage))
+            returncode = subprocess.call(command, shell=True)
+            if returncode != 0:
+                print "Retrying", wid, "from its last checkpoint"
+                returncode = subprocess.call(command + " --resume", shell=True)
+            print returncode
+            if returncode != 0:
+                failed_events.write(line)
+            else:
+                events.append(wid)
         except Exception as e:
             print e
             failed_events.write(line)
 
         if args.emit_events and len(events) >= args.event_size:
             keyname = 'authority_extraction_events/%d' % random.randint(0, 100000000)
-            bucket.new_key(keyname).set_contents_from_string("\n".join(events))
+            store.put(keyname, "\n".join(events))
             events = []
 
     if args.emit_events and len(events) > 0:
         keyname = 'authority_extraction_events/%d' % random.randint(0, 100000000)
-        bucket.new_key(keyname).set_contents_from_string("\n".join(events))
+        store.put(keyname, "\n".join(events))
 
     if args.s3file:
         bucket.delete_key(args.s3file)
@@ -9,6 +9,7 @@ setup(
     license = "Other",
     packages = ["wikia_authority", 'AuthorityReporter', 'AuthorityReporter.library',
                 'AuthorityReporter.library.api', 'AuthorityReporter.library.models'],
-    depends = [ "requests", "lxml", "cssselect", "python-graph-core", "xlrd", "xlwt", "nlp-services>=0.0.1"],
+    depends = [ "requests", "lxml", "cssselect", "numpy>=1.8.0", "python-graph-core", "xlrd", "xlwt",
+                "nlp-services>=0.0.1"],
     dependency_links=["https://github.com/relwell/nlp_services/archive/master.zip#egg=nlp_services=0.0.1"]
     )
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""
+One file holding every page's top authors for a wiki, in place of a result key per page
+"""
+
+import json
+import mmap
+import struct
+import zlib
+from bisect import bisect_right
+import numpy
+from wikia_authority.revisions import StringColumn
+
+
+MAGIC = 'WAPB'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQQ')  # magic, version, entries, blocks, index offset
+BLOCK_SIZE = 16  # entries compressed together; a lookup inflates one block
+
+
+def write_bundle(out, items, block_size=BLOCK_SIZE):
+    """
+    Writes (doc_id, authors) pairs to the seekable file out, returning how many there were.
+
+    Entries are sorted by doc_id and zlib-compressed block_size at a time, as the doc_id, a tab and the
+    authors' JSON on a line each. An index follows the blocks, of where each block starts and the doc_id
+    it starts with, so a reader can find any page's block without reading the others.
+    """
+    items = sorted(items, key=lambda item: item[0])
+    out.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0))  # filled in once the index is written
+    position = HEADER.size
+    block_offsets, first_doc_ids = [position], []
+    for i in range(0, len(items), block_size):
+        block = items[i:i+block_size]
+        first_doc_ids.append(block[0][0])
+        # plain json.dumps escapes non-ASCII, but it's the C encoder, where ensure_ascii=False is pure Python
+        lines = [u'%s\t%s\n' % (doc_id, json.dumps(authors)) for doc_id, authors in block]
+        compressed = zlib.compress(u''.join(lines).encode(u'utf8'))
+        out.write(compressed)
+        position += len(compressed)
+        block_offsets.append(position)
+    padding = -position % 8  # so the index's integers are aligned
+    out.write('\0' * padding)
+    index_offset = position + padding
+    encoded = [doc_id.encode(u'utf8') for doc_id in first_doc_ids]
+    key_offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(doc_id) for doc_id in encoded], out=key_offsets[1:])
+    out.write(numpy.array(block_offsets, dtype=numpy.int64).tostring())
+    out.write(key_offsets.tostring())
+    out.write(''.join(encoded))
+    out.seek(0)
+    out.write(HEADER.pack(MAGIC, VERSION, len(items), len(first_doc_ids), index_offset))
+    return len(items)
+
+
+class PageAuthorityBundle:
+    """
+    Reads a bundle write_bundle wrote, from a string or, with open, a memory-mapped file.
+    get binary-searches the index for the block a doc_id would be in and inflates only that block,
+    so looking up one page never reads the whole wiki.
+    """
+
+    def __init__(self, data):
+        magic, version, self.num_entries, num_blocks, index_offset = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(u'Not a version %d page authority bundle' % VERSION)
+        self.data = data
+        self.block_offsets = numpy.frombuffer(data, dtype=numpy.int64, count=num_blocks + 1, offset=index_offset)
+        key_offsets_at = index_offset + self.block_offsets.nbytes
+        key_offsets = numpy.frombuffer(data, dtype=numpy.int64, count=num_blocks + 1, offset=key_offsets_at)
+        self.first_doc_ids = StringColumn(numpy.frombuffer(data, dtype=numpy.uint8, count=int(key_offsets[-1]),
+                                                           offset=key_offsets_at + key_offsets.nbytes),
+                                          key_offsets)
+        self._block_index = None
+        self._block = None
+
+    @classmethod
+    def open(cls, path):
+        with open(path, u'rb') as bundle_file:
+            return cls(mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self.num_entries
+
+    def block(self, i):
+        """
+        Block i's (doc_ids, authors JSON) lists, as UTF-8 byte strings; the last block read is kept,
+        since lookups tend to cluster
+        """
+        if self._block_index != i:
+            lines = zlib.decompress(self.data[int(self.block_offsets[i]):int(self.block_offsets[i + 1])])
+            entries = [line.split('\t', 1) for line in lines.split('\n')[:-1]]
+            self._block = ([entry[0] for entry in entries], [entry[1] for entry in entries])
+            self._block_index = i
+        return self._block
+
+    def get(self, doc_id, default=None):
+        i = bisect_right(self.first_doc_ids, doc_id) - 1
+        if i < 0:
+            return default
+        doc_ids, authors = self.block(i)
+        doc_id = doc_id.encode(u'utf8') if isinstance(doc_id, unicode) else doc_id
+        j = bisect_right(doc_ids, doc_id) - 1
+        if j < 0 or doc_ids[j] != doc_id:
+            return default
+        return json.loads(authors[j])
+
+    def __contains__(self, doc_id):
+        return self.get(doc_id) is not None
+
+    def iteritems(self):
+        for i in range(len(self.first_doc_ids)):
+            doc_ids, authors = self.block(i)
+            for doc_id, page_authors in zip(doc_ids, authors):
+                yield doc_id.decode(u'utf8'), json.loads(page_authors)
@@ -0,0 +1,82 @@
+"""
+Persistent on-disk cache of MediaWiki API responses
+"""
+
+import hashlib
+import os
+import threading
+import time
+import urllib
+import zlib
+from wikia_authority import sqlitedb
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache keyed by a hash of the normalized request (url plus sorted params).
+    It only holds responses that can never change, e.g. diffs between two fixed revids, so entries
+    don't expire. The file is capped at max_bytes of stored bodies, evicting the least recently read
+    entries first. Connections are opened lazily per process, so one instance can be handed to
+    forked pool workers.
+    """
+
+    schema = [u'CREATE TABLE IF NOT EXISTS responses '
+              u'(key TEXT PRIMARY KEY, body BLOB, size INTEGER, accessed REAL)',
+              u'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)']
+
+    def __init__(self, path, max_bytes=10 * 1024 ** 3, evict_every=500):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._puts = 0
+
+    def _db(self):
+        if self._pid != os.getpid():
+            self._connection = sqlitedb.connect(self.path, self.schema)
+            self._pid = os.getpid()
+            self._puts = 0
+        return self._connection
+
+    @staticmethod
+    def key(url, params):
+        normalized = [(unicode(name).encode(u'utf8'),
+                       value.encode(u'utf8') if isinstance(value, unicode) else str(value))
+                      for name, value in sorted((params or {}).items())]
+        return hashlib.sha1(u'%s?%s' % (url, urllib.urlencode(normalized))).hexdigest()
+
+    def get(self, url, params):
+        key = self.key(url, params)
+        now = time.time()
+        with self.lock:
+            db = self._db()
+            row = db.execute(u'SELECT body FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute(u'UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            db.commit()
+        return zlib.decompress(row[0])
+
+    def put(self, url, params, body):
+        now = time.time()
+        compressed = zlib.compress(body)
+        with self.lock:
+            db = self._db()
+            db.execute(u'INSERT OR REPLACE INTO responses (key, body, size, accessed) VALUES (?, ?, ?, ?)',
+                       (self.key(url, params), buffer(compressed), len(compressed), now))
+            db.commit()
+            self._puts += 1
+            if self._puts % self.evict_every == 0:
+                self._evict(db)
+
+    def _evict(self, db):
+        total = db.execute(u'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        while total > self.max_bytes:
+            victims = db.execute(u'SELECT key, size FROM responses ORDER BY accessed LIMIT 1000').fetchall()
+            if len(victims) == 0:
+                break
+            db.executemany(u'DELETE FROM responses WHERE key = ?', [(victim[0],) for victim in victims])
+            total -= sum([victim[1] for victim in victims])
+        db.commit()
@@ -0,0 +1,115 @@
+"""
+Durable per-stage checkpoints, so a run that dies partway through can pick up where it left off
+"""
+
+import json
+import os
+import shutil
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_directory(directory, write):
+    """
+    Calls write(path) to fill a fresh directory, then swaps it in for directory with renames,
+    so a crash never leaves half of one behind
+    """
+    partial_dir = directory + u'.partial'
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    write(partial_dir)
+    previous_dir = directory + u'.previous'
+    if os.path.isdir(directory):
+        shutil.rmtree(previous_dir, ignore_errors=True)
+        os.rename(directory, previous_dir)
+    os.rename(partial_dir, directory)
+    shutil.rmtree(previous_dir, ignore_errors=True)
+
+
+class JsonLinesLog:
+    """
+    Append-only file of compact JSON records. Each record is flushed to the OS as it's appended, so it
+    survives the process being killed; records are fsync'd every sync_every records and on close, against
+    losing the machine. Reading it back drops a last line cut short by a crash.
+    """
+
+    def __init__(self, path, sync_every=100):
+        self.path = path
+        self.sync_every = sync_every
+        self._file = None
+        self._unsynced = 0
+
+    def append(self, record):
+        if self._file is None:
+            self._file = open(self.path, u'a')
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        if self._file is None or self._unsynced == 0:
+            return
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return
+        for line in open(self.path, u'r'):
+            if not line.endswith('\n'):
+                break  # the write a crash interrupted
+            yield json.loads(line)
+
+
+class Checkpoint:
+    """
+    One wiki run's checkpoint directory. A stage is complete once it's marked done; until then,
+    stages that work page by page log each finished page so a resumed run can skip it.
+    Everything is written to a temporary name and renamed into place, so nothing is half-written.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def done(self, stage):
+        return os.path.isfile(self.path(u'%s.done' % stage))
+
+    def mark_done(self, stage):
+        self.write_json(u'%s.done' % stage, True)
+
+    def write_json(self, name, value):
+        partial = self.path(name + u'.partial')
+        with open(partial, u'w') as partial_file:
+            json.dump(value, partial_file, separators=(',', ':'))
+            partial_file.flush()
+            os.fsync(partial_file.fileno())
+        os.rename(partial, self.path(name))
+        fsync_directory(self.directory)
+
+    def read_json(self, name):
+        with open(self.path(name), u'r') as json_file:
+            return json.load(json_file)
+
+    def log(self, stage, sync_every=100):
+        return JsonLinesLog(self.path(u'%s.jsonl' % stage), sync_every=sync_every)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,27 @@
+"""
+Counters that can be read back in the parent after forked pool workers bump them
+"""
+
+import multiprocessing
+
+
+class SharedCounters:
+    """
+    A named set of integer counters living in shared memory. Build it in the parent
+    before the pool is created and hand it to workers through the pool initializer.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.values = dict([(name, multiprocessing.Value('l', 0)) for name in self.names])
+
+    def incr(self, name, amount=1):
+        value = self.values[name]
+        with value.get_lock():
+            value.value += amount
+
+    def get(self, name):
+        return self.values[name].value
+
+    def as_dict(self):
+        return dict([(name, self.get(name)) for name in self.names])
@@ -0,0 +1,113 @@
+"""
+Edit distances shared by every worker and every run
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from wikia_authority.counters import SharedCounters
+from wikia_authority import sqlitedb
+
+
+class LRUCache:
+    """
+    Small in-process least recently used map
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+
+class EditDistanceStore:
+    """
+    Edit distances keyed by (wiki_id, earlier_revid, later_revid), kept in SQLite so that all pool
+    workers, and later runs, see each other's results, with an LRU in front for this process.
+    Writes are buffered and committed in groups; call flush() when a unit of work is done.
+    Build it in the parent before the pool forks, so workers inherit it; connections open per process.
+    """
+
+    schema = [u'CREATE TABLE IF NOT EXISTS edit_distances (wiki_id TEXT, earlier INTEGER, '
+              u'later INTEGER, distance REAL, PRIMARY KEY (wiki_id, earlier, later))']
+
+    def __init__(self, path, lru_capacity=100000, flush_every=200):
+        self.path = path
+        self.flush_every = flush_every
+        self.lru = LRUCache(lru_capacity)
+        self.counters = SharedCounters([u'memory_hits', u'store_hits', u'misses'])
+        self.lock = threading.Lock()
+        self._pending = []
+        self._connection = None
+        self._pid = None
+
+    def _db(self):
+        if self._pid != os.getpid():
+            self._connection = sqlitedb.connect(self.path, self.schema)
+            self._pid = os.getpid()
+            self._pending = []
+            self.lru = LRUCache(self.lru.capacity)
+        return self._connection
+
+    def get(self, wiki_id, earlier_revision, later_revision):
+        """
+        Returns the stored distance or None
+        """
+        key = (wiki_id, earlier_revision, later_revision)
+        with self.lock:
+            db = self._db()
+        distance = self.lru.get(key)
+        if distance is not None:
+            self.counters.incr(u'memory_hits')
+            return distance
+        with self.lock:
+            row = db.execute(u'SELECT distance FROM edit_distances WHERE wiki_id = ? AND earlier = ? AND later = ?',
+                             (unicode(wiki_id), earlier_revision, later_revision)).fetchone()
+        if row is None:
+            self.counters.incr(u'misses')
+            return None
+        self.lru.put(key, row[0])
+        self.counters.incr(u'store_hits')
+        return row[0]
+
+    def put(self, wiki_id, earlier_revision, later_revision, distance):
+        self.lru.put((wiki_id, earlier_revision, later_revision), distance)
+        with self.lock:
+            self._db()
+            self._pending.append((unicode(wiki_id), earlier_revision, later_revision, distance))
+            if len(self._pending) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._db()
+            self._flush()
+
+    def _flush(self):
+        if len(self._pending) == 0:
+            return
+        self._connection.executemany(u'INSERT OR REPLACE INTO edit_distances (wiki_id, earlier, later, distance) '
+                                     u'VALUES (?, ?, ?, ?)', self._pending)
+        self._connection.commit()
+        self._pending = []
+
+    def stats(self):
+        counts = self.counters.as_dict()
+        lookups = sum(counts.values())
+        rates = dict([(name + u'_pct', 100.0 * value / lookups if lookups else 0.0) for name, value in counts.items()])
+        rates.update(counts)
+        return rates
@@ -0,0 +1,27 @@
+"""
+Thread-backed fetch engine for the I/O-bound stages of authority extraction
+"""
+
+from multiprocessing.pool import ThreadPool
+
+
+class FetchEngine:
+    """
+    Keeps up to `concurrency` API requests in flight from a single process.
+    The threads spend nearly all of their time blocked on sockets, so this replaces
+    a process per request slot without paying for a full interpreter per slot.
+    """
+
+    def __init__(self, concurrency=100):
+        self.concurrency = concurrency
+        self.pool = ThreadPool(processes=concurrency)
+
+    def map(self, func, iterable):
+        return self.pool.map(func, iterable, chunksize=1)
+
+    def imap_unordered(self, func, iterable):
+        return self.pool.imap_unordered(func, iterable)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,215 @@
+"""
+Compressed sparse row link graphs over integer node ids, and PageRank on them
+"""
+
+import os
+from array import array
+import numpy
+from wikia_authority.revisions import StringColumn
+
+
+class GraphBuilder:
+    """
+    Maps node names to integer ids as they're first seen and collects (source, target) edges between them
+    """
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.sources = array('l')
+        self.targets = array('l')
+
+    def node_id(self, name):
+        node = self.ids.get(name)
+        if node is None:
+            node = len(self.names)
+            self.ids[name] = node
+            self.names.append(name)
+        return node
+
+    def add_nodes(self, names):
+        for name in names:
+            self.node_id(name)
+
+    def add_edge(self, source, target):
+        self.sources.append(source)
+        self.targets.append(target)
+
+    def add_links(self, source_name, target_names):
+        source = self.node_id(source_name)
+        for target_name in target_names:
+            self.add_edge(source, self.node_id(target_name))
+
+    def build(self):
+        return CSRGraph.from_edges(len(self.names), numpy.array(self.sources, dtype=numpy.int64),
+                                   numpy.array(self.targets, dtype=numpy.int64))
+
+
+class BipartiteBuilder:
+    """
+    Page -> author edges, built up one page's author list at a time. Pages are numbered in the order
+    they're added and take node ids 0 through num_pages - 1; authors get the ids after them, so a page
+    and an author can never be mistaken for one another whatever they're called.
+    """
+
+    def __init__(self):
+        self.num_pages = 0
+        self.author_names = []
+        self.author_ids = {}
+        self.pages = array('l')
+        self.authors = array('l')
+
+    def author_id(self, name):
+        author = self.author_ids.get(name)
+        if author is None:
+            author = len(self.author_names)
+            self.author_ids[name] = author
+            self.author_names.append(name)
+        return author
+
+    def add_page(self, author_names):
+        page = self.num_pages
+        self.num_pages += 1
+        for name in author_names:
+            self.pages.append(page)
+            self.authors.append(self.author_id(name))
+        return page
+
+    def build(self):
+        return CSRGraph.from_edges(self.num_pages + len(self.author_names), numpy.array(self.pages, dtype=numpy.int64),
+                                   numpy.array(self.authors, dtype=numpy.int64) + self.num_pages)
+
+
+def author_centrality(builder, damping_factor=0.85, max_iterations=100, tolerance=0.00001, previous=None):
+    """
+    (ranks, iterations, residual): PageRank of each author, in the order of builder.author_names, on the
+    graph of pages linking to their authors. Authors have no out links, and their rank is dropped rather
+    than spread back out, the same as the pygraph digraph this replaced. previous maps author names to
+    the ranks a previous run ended up with, to start from.
+    """
+    author_graph = builder.build()
+    minimum = (1.0 - damping_factor) / author_graph.num_nodes()
+    initial = None
+    if previous:
+        # pages have no in links, so their rank is known up front
+        initial = numpy.concatenate([numpy.repeat(minimum, builder.num_pages),
+                                     warm_start(builder.author_names, previous, minimum)])
+    ranks, iterations, residual = pagerank(author_graph, damping_factor=damping_factor, tolerance=tolerance,
+                                           max_iterations=max_iterations, dangling=False, initial=initial)
+    return ranks[builder.num_pages:], iterations, residual
+
+
+class CSRGraph:
+    """
+    A directed graph as out-edge lists: node i links to targets[offsets[i]:offsets[i+1]].
+    Repeated edges are dropped, the way a pygraph digraph refuses to add one twice.
+    """
+
+    def __init__(self, offsets, targets):
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def from_edges(cls, num_nodes, sources, targets):
+        if len(sources) > 0:
+            edges = numpy.unique(sources * num_nodes + targets)
+            sources, targets = edges // num_nodes, edges % num_nodes
+        offsets = numpy.zeros(num_nodes + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(sources, minlength=num_nodes), out=offsets[1:])
+        return cls(offsets, targets.astype(numpy.int64))
+
+    def num_nodes(self):
+        return len(self.offsets) - 1
+
+    def num_edges(self):
+        return len(self.targets)
+
+    def out_degrees(self):
+        return numpy.diff(self.offsets)
+
+    def sources(self):
+        return numpy.repeat(numpy.arange(self.num_nodes()), self.out_degrees())
+
+    def save(self, directory, names):
+        """
+        Writes the graph as offsets.npy and targets.npy, with the node names alongside, for load to map back in
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        numpy.save(os.path.join(directory, u'offsets.npy'), self.offsets)
+        numpy.save(os.path.join(directory, u'targets.npy'), self.targets)
+        StringColumn.save(os.path.join(directory, u'names'), names)
+
+    @staticmethod
+    def saved_in(directory):
+        return os.path.isfile(os.path.join(directory, u'offsets.npy'))
+
+    @classmethod
+    def load(cls, directory, mmap_mode=u'r'):
+        """
+        (names, graph) as save left them, memory-mapped by default so a large graph is never read in whole
+        """
+        return (StringColumn.load(os.path.join(directory, u'names'), mmap_mode=mmap_mode),
+                cls(numpy.load(os.path.join(directory, u'offsets.npy'), mmap_mode=mmap_mode),
+                    numpy.load(os.path.join(directory, u'targets.npy'), mmap_mode=mmap_mode)))
+
+
+def pagerank(graph, damping_factor=0.85, max_iterations=100, tolerance=0.00001, dangling=True, initial=None):
+    """
+    (ranks, iterations, residual): PageRank of every node of a CSRGraph as an array, by power iteration
+    until the total change in rank, the residual, drops below tolerance. Rank sitting on nodes with no
+    out links is spread evenly over every node when dangling is on; with it off, that rank is dropped,
+    as pygraph's pagerank does. Iteration starts from initial if given, e.g. the ranks of the last run;
+    if those are already within tolerance they come back as they are, so an unchanged graph keeps its ranks.
+    """
+    num_nodes = graph.num_nodes()
+    if num_nodes == 0:
+        return numpy.zeros(0), 0, 0.0
+    out_degrees = graph.out_degrees()
+    is_dangling = out_degrees == 0
+    inverse_degrees = 1.0 / numpy.where(is_dangling, 1, out_degrees)
+    sources, targets = graph.sources(), graph.targets
+    if initial is not None:
+        ranks = numpy.array(initial, dtype=numpy.float64)
+    else:
+        ranks = numpy.empty(num_nodes)
+        ranks.fill(1.0 / num_nodes)
+    iterations, delta = 0, 0.0
+    for iterations in range(1, max_iterations + 1):
+        shares = ranks * inverse_degrees
+        new_ranks = damping_factor * numpy.bincount(targets, weights=shares[sources], minlength=num_nodes)
+        base = (1.0 - damping_factor) / num_nodes
+        if dangling:
+            base += damping_factor * ranks[is_dangling].sum() / num_nodes
+        new_ranks += base
+        delta = numpy.abs(new_ranks - ranks).sum()
+        if delta < tolerance and iterations == 1 and initial is not None:
+            break
+        ranks = new_ranks
+        if delta < tolerance:
+            break
+    return ranks, iterations, delta
+
+
+def warm_start(names, previous, default):
+    """
+    Starting ranks for nodes in the order of names: what they had last time, or default for new ones
+    """
+    return numpy.array([previous.get(name, default) for name in names], dtype=numpy.float64)
+
+
+def save_ranks(directory, names, ranks):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    StringColumn.save(os.path.join(directory, u'names'), names)
+    numpy.save(os.path.join(directory, u'ranks.npy'), ranks)
+
+
+def load_ranks(directory):
+    """
+    The ranks save_ranks left in directory, keyed by node name, or an empty dict if there aren't any
+    """
+    if not os.path.isfile(os.path.join(directory, u'ranks.npy')):
+        return {}
+    return dict(zip(StringColumn.load(os.path.join(directory, u'names'), mmap_mode=None),
+                    numpy.load(os.path.join(directory, u'ranks.npy')).tolist()))
@@ -0,0 +1,54 @@
+"""
+JSON encoding of large mappings a slice at a time, so a wiki-wide result is never one string in memory
+"""
+
+import gzip
+import json
+from itertools import islice
+
+
+def iter_json_object(mapping, chunk_size=10000):
+    """
+    Yields mapping as a JSON object in pieces of chunk_size items, each piece encoded by json.dumps
+    """
+    yield u'{'
+    items = mapping.iteritems()
+    separator = u''
+    while True:
+        chunk = list(islice(items, chunk_size))
+        if not chunk:
+            break
+        yield separator + json.dumps(dict(chunk), ensure_ascii=False)[1:-1]
+        separator = u', '
+    yield u'}'
+
+
+def write_json_object(out, mapping, chunk_size=10000):
+    """
+    Writes mapping to the file out as UTF-8 JSON, returning how many bytes that came to
+    """
+    written = 0
+    for piece in iter_json_object(mapping, chunk_size=chunk_size):
+        piece = piece.encode(u'utf8')
+        out.write(piece)
+        written += len(piece)
+    return written
+
+
+def write_json(path, mapping, chunk_size=10000):
+    with open(path, u'wb') as json_file:
+        return write_json_object(json_file, mapping, chunk_size=chunk_size)
+
+
+def write_json_gz(path, mapping, chunk_size=10000, compresslevel=6):
+    """
+    Writes mapping to path as gzipped JSON, returning how many bytes of JSON went into it.
+    The gzip header is left without a timestamp or file name, so the same mapping always makes the same file.
+    compresslevel is zlib's default rather than gzip's 9, which is several times slower for about 1% smaller.
+    """
+    with open(path, u'wb') as raw_file:
+        gzip_file = gzip.GzipFile(filename='', mode='wb', compresslevel=compresslevel, fileobj=raw_file, mtime=0)
+        try:
+            return write_json_object(gzip_file, mapping, chunk_size=chunk_size)
+        finally:
+            gzip_file.close()
@@ -0,0 +1,86 @@
+"""
+Request rate limiting shared across every process working on a wiki
+"""
+
+import multiprocessing
+import random
+import time
+
+
+RATE, TOKENS, UPDATED_AT, LAST_DECREASE, THROTTLED, LATENCY = range(6)
+
+
+class RateLimiter:
+    """
+    A token bucket in shared memory, so the ceiling holds for the whole run and not per worker.
+    The refill rate follows AIMD: it creeps up while responses come back quickly and is cut
+    multiplicatively on errors, or when responses are slow on average, never going past max_rate.
+    Latency is smoothed over recent responses, weighting each by latency_weight, so the odd slow
+    one, like a big rendered diff, doesn't cut the rate for everyone.
+    Build it in the parent and pass it to workers through the pool initializer.
+    """
+
+    def __init__(self, max_rate=400.0, min_rate=1.0, target_latency=2.0, increase=1.0, decrease=0.5,
+                 decrease_interval=1.0, latency_weight=0.02):
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min(min_rate, max_rate))
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.decrease_interval = decrease_interval
+        self.latency_weight = latency_weight
+        self.burst = max(1.0, self.max_rate)
+        self.lock = multiprocessing.Lock()
+        self.state = multiprocessing.RawArray('d', [self.max_rate, self.burst, time.time(), 0.0, 0.0, 0.0])
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self.state[UPDATED_AT])
+        self.state[TOKENS] = min(self.burst, self.state[TOKENS] + elapsed * self.state[RATE])
+        self.state[UPDATED_AT] = now
+
+    def acquire(self):
+        """
+        Blocks until this request is allowed to go out
+        """
+        throttled = False
+        while True:
+            with self.lock:
+                self._refill(time.time())
+                if self.state[TOKENS] >= 1:
+                    self.state[TOKENS] -= 1
+                    return
+                if not throttled:
+                    self.state[THROTTLED] += 1
+                    throttled = True
+                wait = (1 - self.state[TOKENS]) / self.state[RATE]
+            time.sleep(wait)
+
+    def record(self, latency, error=False):
+        """
+        Feeds one response back into the rate. Decreases are spaced out so a burst of
+        concurrent failures only counts as one congestion signal.
+        """
+        with self.lock:
+            now = time.time()
+            self.state[LATENCY] += self.latency_weight * (latency - self.state[LATENCY])
+            if error or self.state[LATENCY] > self.target_latency:
+                if now - self.state[LAST_DECREASE] >= self.decrease_interval:
+                    self._refill(now)
+                    self.state[RATE] = max(self.min_rate, self.state[RATE] * self.decrease)
+                    self.state[LAST_DECREASE] = now
+            else:
+                self._refill(now)
+                # roughly +increase requests/sec for every second's worth of good responses
+                self.state[RATE] = min(self.max_rate, self.state[RATE] + self.increase / self.state[RATE])
+
+    def stats(self):
+        with self.lock:
+            return {u'rate': self.state[RATE], u'throttled': int(self.state[THROTTLED]),
+                    u'latency': self.state[LATENCY]}
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=60.0):
+    """
+    Full-jitter exponential backoff, so retrying workers don't come back in lockstep
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
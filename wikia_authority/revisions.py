@@ -0,0 +1,247 @@
+"""
+Columnar storage for a wiki's revision history
+"""
+
+import math
+import os
+import sys
+from array import array
+import numpy
+
+
+MISSING = -1  # stands in for a key the API left off a revision, e.g. the user on a hidden revision
+UNSCORED = float(u'nan')  # edit longevity of a revision that hasn't been worked out
+FINAL_WINDOW = 10  # a revision's longevity stops changing once this many revisions follow it
+
+
+class RevisionStoreBuilder:
+    """
+    Accumulates pages of revisions, as they come back from the API, into typed columns
+    """
+
+    def __init__(self, sample_size=10000):
+        self.titles = []
+        self.pageids = array('l')
+        self.offsets = array('l', [0])
+        self.revids = array('l')
+        self.parentids = array('l')
+        self.userids = array('l')
+        self.users = array('l')
+        self.longevity = array('d')
+        self.scored = array('l')
+        self.names = []
+        self.name_ids = {}
+        self.sample_size = sample_size
+        self.sampled_revisions = 0
+        self.sampled_bytes = 0
+
+    def intern_name(self, name):
+        if name not in self.name_ids:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return self.name_ids[name]
+
+    def add_page(self, title, pageid, revisions, scored=0):
+        """
+        scored is how many of the page's leading revisions already had their longevity worked out
+        against the rest of the history, when a page carried over from an earlier run has grown
+        """
+        self.titles.append(title)
+        self.pageids.append(pageid)
+        self.scored.append(scored)
+        for revision in revisions:
+            if self.sampled_revisions < self.sample_size:
+                self.sampled_revisions += 1
+                self.sampled_bytes += dict_bytes(revision)
+            self.revids.append(revision.get(u'revid', MISSING))
+            self.parentids.append(revision.get(u'parentid', MISSING))
+            self.userids.append(revision.get(u'userid', MISSING))
+            self.users.append(self.intern_name(revision[u'user']) if u'user' in revision else MISSING)
+            self.longevity.append(revision.get(u'edit_longevity', UNSCORED))
+        self.offsets.append(len(self.revids))
+
+    def dict_bytes_per_revision(self):
+        """
+        What a revision cost as a JSON dict, measured on the first sample_size revisions added
+        """
+        return float(self.sampled_bytes) / max(1, self.sampled_revisions)
+
+    def build(self):
+        return RevisionStore(self.titles,
+                             numpy.array(self.pageids, dtype=numpy.int64),
+                             numpy.array(self.offsets, dtype=numpy.int64),
+                             numpy.array(self.revids, dtype=numpy.int64),
+                             numpy.array(self.parentids, dtype=numpy.int64),
+                             numpy.array(self.userids, dtype=numpy.int64),
+                             numpy.array(self.users, dtype=numpy.int32),
+                             numpy.array(self.longevity, dtype=numpy.float64),
+                             numpy.array(self.scored, dtype=numpy.int64),
+                             self.names)
+
+
+class RevisionStore:
+    """
+    Every page's revisions as flat revid, parentid, userid and user columns, with page i's revisions
+    at offsets[i]:offsets[i+1], in the order the API returned them. User names are interned, so
+    each distinct editor's name is held once. page_revisions hands back the dicts the authority
+    stages expect, one page at a time.
+
+    A store can be saved to a directory of .npy columns and loaded back memory-mapped, so pool
+    workers can all read one copy of it instead of being sent each page's revisions.
+
+    Each revision's edit longevity is kept too, along with how many of each page's revisions it has
+    been scored for, so a later run only has to score the windows its new revisions fall in.
+    """
+
+    columns = [u'pageids', u'offsets', u'revids', u'parentids', u'userids', u'users', u'longevity', u'scored']
+
+    def __init__(self, titles, pageids, offsets, revids, parentids, userids, users, longevity, scored, names):
+        self.titles = titles
+        self.pageids = pageids
+        self.offsets = offsets
+        self.revids = revids
+        self.parentids = parentids
+        self.userids = userids
+        self.users = users
+        self.longevity = longevity
+        self.scored = scored
+        self.names = names
+        self._pageid_indices = None
+
+    def __len__(self):
+        return len(self.revids)
+
+    def num_pages(self):
+        return len(self.titles)
+
+    def pageid_index(self, pageid):
+        if self._pageid_indices is None:
+            self._pageid_indices = dict([(page_id, i) for i, page_id in enumerate(self.pageids.tolist())])
+        return self._pageid_indices.get(pageid)
+
+    def last_revid(self, page_index):
+        """
+        The newest revid held for a page, or None if there isn't one to pick up from
+        """
+        start, end = self.offsets[page_index], self.offsets[page_index + 1]
+        if start == end or self.revids[end - 1] == MISSING:
+            return None
+        return int(self.revids[end - 1])
+
+    def unscored_start(self, page_index):
+        """
+        Index of the first of a page's revisions whose longevity has to be worked out (again)
+        """
+        num_revisions = int(self.offsets[page_index + 1] - self.offsets[page_index])
+        scored = int(self.scored[page_index])
+        if scored >= num_revisions:
+            return num_revisions
+        # the last FINAL_WINDOW scored revisions looked at a shorter tail than the page has now
+        return max(0, scored - FINAL_WINDOW)
+
+    def record_longevity(self, page_index, title_revs):
+        """
+        Writes back the edit_longevity get_contributing_authors set on a page's revisions
+        """
+        start = self.offsets[page_index]
+        self.longevity[start:start + len(title_revs)] = [title_rev.get(u'edit_longevity', UNSCORED)
+                                                         for title_rev in title_revs]
+        self.scored[page_index] = len(title_revs)
+
+    def title_object(self, page_index):
+        return {u'title': self.titles[page_index], u'pageid': int(self.pageids[page_index])}
+
+    def page_revisions(self, page_index):
+        start, end = self.offsets[page_index], self.offsets[page_index + 1]
+        revisions = []
+        for revid, parentid, userid, user, longevity in zip(self.revids[start:end].tolist(),
+                                                            self.parentids[start:end].tolist(),
+                                                            self.userids[start:end].tolist(),
+                                                            self.users[start:end].tolist(),
+                                                            self.longevity[start:end].tolist()):
+            revision = {}
+            if revid != MISSING:
+                revision[u'revid'] = revid
+            if parentid != MISSING:
+                revision[u'parentid'] = parentid
+            if userid != MISSING:
+                revision[u'userid'] = userid
+            if user != MISSING:
+                revision[u'user'] = self.names[user]
+            if not math.isnan(longevity):
+                revision[u'edit_longevity'] = longevity
+            revisions.append(revision)
+        return revisions
+
+    def nbytes(self):
+        columns = [self.offsets, self.revids, self.parentids, self.userids, self.users, self.longevity]
+        return sum([column.nbytes for column in columns]) + sum([sys.getsizeof(name) for name in self.names])
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for column in self.columns:
+            numpy.save(os.path.join(directory, u'%s.npy' % column), getattr(self, column))
+        StringColumn.save(os.path.join(directory, u'titles'), self.titles)
+        StringColumn.save(os.path.join(directory, u'names'), self.names)
+
+    def load_scores(self, directory):
+        """
+        Picks up the longevity workers wrote into a saved copy of this store
+        """
+        self.longevity = numpy.load(os.path.join(directory, u'longevity.npy'))
+        self.scored = numpy.load(os.path.join(directory, u'scored.npy'))
+
+    @staticmethod
+    def saved_in(directory):
+        return os.path.isfile(os.path.join(directory, u'offsets.npy'))
+
+    @classmethod
+    def load(cls, directory, mmap_mode=u'r', writable=()):
+        """
+        Columns named in writable are mapped read-write, so what a worker writes into them lands in the files
+        """
+        columns = dict([(column, numpy.load(os.path.join(directory, u'%s.npy' % column),
+                                            mmap_mode=u'r+' if column in writable else mmap_mode))
+                        for column in cls.columns])
+        return cls(StringColumn.load(os.path.join(directory, u'titles'), mmap_mode=mmap_mode),
+                   names=StringColumn.load(os.path.join(directory, u'names'), mmap_mode=mmap_mode),
+                   **columns)
+
+
+class StringColumn:
+    """
+    A read-only list of unicode strings kept as one UTF-8 blob plus offsets, so it can be memory-mapped
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tostring().decode(u'utf8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @staticmethod
+    def save(prefix, strings):
+        encoded = [string.encode(u'utf8') for string in strings]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(string) for string in encoded], out=offsets[1:])
+        numpy.save(prefix + u'_offsets.npy', offsets)
+        numpy.save(prefix + u'_blob.npy', numpy.frombuffer(''.join(encoded) or ' ', dtype=numpy.uint8))
+
+    @classmethod
+    def load(cls, prefix, mmap_mode=u'r'):
+        return cls(numpy.load(prefix + u'_blob.npy', mmap_mode=mmap_mode),
+                   numpy.load(prefix + u'_offsets.npy', mmap_mode=mmap_mode))
+
+
+def dict_bytes(revision):
+    # keys are shared between revisions by the json decoder, so only the dict and its values count
+    return sys.getsizeof(revision) + sum([sys.getsizeof(value) for value in revision.values()])
@@ -0,0 +1,137 @@
+"""
+Per-worker keep-alive HTTP session for talking to the MediaWiki API
+"""
+
+import json
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from wikia_authority.counters import SharedCounters
+from wikia_authority.ratelimit import backoff_delay
+
+
+_session = None
+_counters = None
+_limiter = None
+_cache = None
+_retries = 3
+_pool_snapshot = (0, 0)
+_snapshot_lock = threading.Lock()
+
+
+def connection_counters():
+    """
+    Counters for connections opened vs. reused and for cache hits, shareable across pool workers
+    """
+    return SharedCounters([u'connections_opened', u'connections_reused', u'cache_hits'])
+
+
+def init_session(pool_size=10, counters=None, limiter=None, retries=3, cache=None):
+    """
+    Builds this process's session. Meant to run once per worker as a pool initializer,
+    so each process keeps its own sockets alive instead of inheriting the parent's.
+    If a shared RateLimiter is given, every request waits on it and reports back to it.
+    If a ResponseCache is given, get_json answers from it when it can.
+    """
+    global _session, _counters, _pool_snapshot, _limiter, _retries, _cache
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount(u'http://', adapter)
+    session.mount(u'https://', adapter)
+    _session = session
+    _counters = counters
+    _limiter = limiter
+    _retries = retries
+    _cache = cache
+    _pool_snapshot = (0, 0)
+    return session
+
+
+def get_session():
+    if _session is None:
+        init_session()
+    return _session
+
+
+def _pool_totals(session):
+    opened, requested = 0, 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools[pool_key]
+            opened += pool.num_connections
+            requested += pool.num_requests
+    return opened, requested
+
+
+def _record_connections(session):
+    global _pool_snapshot
+    if _counters is None:
+        return
+    with _snapshot_lock:
+        opened, requested = _pool_totals(session)
+        new_opened = opened - _pool_snapshot[0]
+        new_requests = requested - _pool_snapshot[1]
+        _pool_snapshot = (opened, requested)
+    if new_opened > 0:
+        _counters.incr(u'connections_opened', new_opened)
+    if new_requests > new_opened:
+        _counters.incr(u'connections_reused', new_requests - new_opened)
+
+
+def get(url, params=None, **kwargs):
+    """
+    Drop-in for requests.get that goes through this process's pooled session.
+    Connection errors and 429/5xx responses are retried with jittered backoff;
+    the last ConnectionError is re-raised once retries run out.
+    """
+    session = get_session()
+    attempt = 0
+    while True:
+        if _limiter is not None:
+            _limiter.acquire()
+        start = time.time()
+        try:
+            resp = session.get(url, params=params, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if _limiter is not None:
+                _limiter.record(time.time() - start, error=True)
+            if attempt >= _retries:
+                raise
+        else:
+            _record_connections(session)
+            failed = resp.status_code == 429 or resp.status_code >= 500
+            if _limiter is not None:
+                _limiter.record(time.time() - start, error=failed)
+            if not failed or attempt >= _retries:
+                return resp
+            resp.close()
+        time.sleep(backoff_delay(attempt))
+        attempt += 1
+
+
+def get_json(url, params=None, permanent=False):
+    """
+    Fetches and decodes an API response. permanent marks responses that can never change, such as
+    a diff between two fixed revids; only those go through the response cache, if there is one.
+    Listings of titles, revisions and links always come from the API, or an incremental run would
+    replay what the last one saw. Raises ValueError on a body that isn't JSON.
+    """
+    cache = _cache if permanent else None
+    if cache is not None:
+        body = cache.get(url, params)
+        if body is not None:
+            if _counters is not None:
+                _counters.incr(u'cache_hits')
+            return json.loads(body)
+    resp = get(url, params=params)
+    body = resp.content
+    resp.close()
+    try:
+        response = json.loads(body)
+    except ValueError:
+        raise ValueError(u"Couldn't decode response from %s: %r" % (url, body[:500]))
+    if cache is not None and resp.status_code == 200 and u'error' not in response:
+        cache.put(url, params, body)
+    return response
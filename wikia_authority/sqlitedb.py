@@ -0,0 +1,26 @@
+"""
+SQLite files shared by every pool worker
+"""
+
+import os
+import sqlite3
+
+
+def connect(path, schema):
+    """
+    Opens the SQLite file at path, making its directory if need be, in WAL mode so readers in other
+    processes don't wait on a writer, and runs each statement in schema, e.g. CREATE TABLE IF NOT EXISTS.
+    Connections can't be shared across a fork, so callers open one per process.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # another worker got there first
+    connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    connection.execute(u'PRAGMA journal_mode=WAL')
+    for statement in schema:
+        connection.execute(statement)
+    connection.commit()
+    return connection
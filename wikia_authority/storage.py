@@ -0,0 +1,264 @@
+"""
+Where extraction results get written: S3 for production, or a local directory or SQLite file for offline
+runs and benchmarks. open_result_store picks one from a location given on the command line.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+from boto import connect_s3
+from wikia_authority import sqlitedb
+
+
+class ResultStore:
+    """
+    Reads and writes keyed results. The batched put_many, get_many and exists_many keep up to
+    `concurrency` requests in flight at once. Clients and threads are opened lazily, per thread and
+    per process, so one instance can be built in the parent and handed to forked pool workers
+    through the initializer.
+    """
+
+    def __init__(self, concurrency=8):
+        self.concurrency = concurrency
+        self._local = threading.local()
+        self._threads = None
+        self._pid = None
+
+    def client(self):
+        if getattr(self._local, u'pid', None) != os.getpid():
+            self._local.client = self.connect()
+            self._local.pid = os.getpid()
+        return self._local.client
+
+    def connect(self):
+        return None
+
+    def put(self, key, body):
+        raise NotImplementedError()
+
+    def put_file(self, key, path):
+        """
+        Writes the contents of a local file under key, returning how many bytes went out
+        """
+        with open(path, u'rb') as body_file:
+            return self.put(key, body_file.read())
+
+    def get(self, key):
+        """
+        The body stored under key as a byte string, or None if there isn't one
+        """
+        raise NotImplementedError()
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def map(self, function, items):
+        if self._pid != os.getpid():
+            self._threads = ThreadPool(processes=self.concurrency)
+            self._pid = os.getpid()
+        return self._threads.map(function, items, chunksize=1)
+
+    def put_many(self, items):
+        """
+        Writes every (key, body) in items, returning how many bytes went out
+        """
+        return sum(self.map(lambda item: self.put(*item), items))
+
+    def put_changed(self, items):
+        """
+        Writes the (key, body, previous digest) items whose body hashes to something other than the digest
+        it had last time. Returns each key's (key, digest), the bytes written, and how many writes and
+        bytes were skipped.
+        """
+        digests, changed, skipped, saved = [], [], 0, 0
+        for key, body, previous_digest in items:
+            body = encode(body)
+            body_digest = digest(body)
+            digests.append((key, body_digest))
+            if body_digest == previous_digest:
+                skipped += 1
+                saved += len(body)
+            else:
+                changed.append((key, body))
+        return digests, self.put_many(changed), skipped, saved
+
+    def get_many(self, keys):
+        return self.map(self.get, keys)
+
+    def exists_many(self, keys):
+        return self.map(self.exists, keys)
+
+
+def encode(body):
+    return body.encode(u'utf8') if isinstance(body, unicode) else body
+
+
+def digest(body):
+    return hashlib.md5(encode(body)).hexdigest()
+
+
+def file_digest(path, chunk_size=1024 ** 2):
+    md5 = hashlib.md5()
+    with open(path, u'rb') as body_file:
+        for chunk in iter(lambda: body_file.read(chunk_size), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class S3ResultStore(ResultStore):
+    """
+    Keys in an S3 bucket, with one boto connection per thread reused across every request it makes
+    """
+
+    def __init__(self, bucket_name=u'nlp-data', concurrency=8):
+        ResultStore.__init__(self, concurrency=concurrency)
+        self.bucket_name = bucket_name
+
+    def connect(self):
+        return connect_s3().get_bucket(self.bucket_name, validate=False)
+
+    def put(self, key, body):
+        body = encode(body)
+        self.client().new_key(key_name=key).set_contents_from_string(body)
+        return len(body)
+
+    def put_file(self, key, path):
+        # boto streams the file up, a part at a time
+        self.client().new_key(key_name=key).set_contents_from_filename(path)
+        return os.path.getsize(path)
+
+    def get(self, key):
+        s3_key = self.client().get_key(key)
+        return None if s3_key is None else s3_key.get_contents_as_string()
+
+    def exists(self, key):
+        # a HEAD request, without pulling down the body
+        return self.client().get_key(key) is not None
+
+
+class LocalResultStore(ResultStore):
+    """
+    Keys as files under a root directory, each written to a temporary name and renamed into place
+    """
+
+    def __init__(self, root, concurrency=8):
+        ResultStore.__init__(self, concurrency=concurrency)
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key.lstrip(u'/'))
+
+    def partial_path(self, key):
+        """
+        Where to write key before renaming it into place, making its directory if need be
+        """
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass  # another thread got there first
+        return u'%s.%d.%d.partial' % (path, os.getpid(), threading.current_thread().ident)
+
+    def put(self, key, body):
+        body = encode(body)
+        partial = self.partial_path(key)
+        with open(partial, u'wb') as partial_file:
+            partial_file.write(body)
+        os.rename(partial, self.path(key))
+        return len(body)
+
+    def put_file(self, key, path):
+        partial = self.partial_path(key)
+        shutil.copyfile(path, partial)
+        os.rename(partial, self.path(key))
+        return os.path.getsize(path)
+
+    def get(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, u'rb') as result_file:
+            return result_file.read()
+
+    def exists(self, key):
+        return os.path.isfile(self.path(key))
+
+
+class SQLiteResultStore(ResultStore):
+    """
+    Keys as rows of one SQLite file. A batch is one transaction rather than concurrent requests, since
+    SQLite takes one writer at a time anyway; pool workers each get their own connection and take turns.
+    """
+
+    query_size = 500  # keys per IN (...) lookup, under SQLite's limit on bound parameters
+    schema = [u'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, body BLOB)']
+
+    def __init__(self, path, concurrency=8):
+        ResultStore.__init__(self, concurrency=concurrency)
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+
+    def _db(self):
+        if self._connection_pid != os.getpid():
+            self._connection = sqlitedb.connect(self.path, self.schema)
+            self._connection_pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def normalize(key):
+        # the same key whether or not it was given with S3's leading slash
+        return key.lstrip(u'/')
+
+    def put(self, key, body):
+        return self.put_many([(key, body)])
+
+    def put_many(self, items):
+        rows = [(self.normalize(key), buffer(encode(body))) for key, body in items]
+        with self.lock:
+            db = self._db()
+            db.executemany(u'INSERT OR REPLACE INTO results (key, body) VALUES (?, ?)', rows)
+            db.commit()
+        return sum([len(body) for key, body in rows])
+
+    def _select(self, column, keys):
+        keys = [self.normalize(key) for key in keys]
+        found = {}
+        with self.lock:
+            db = self._db()
+            for i in range(0, len(keys), self.query_size):
+                batch = keys[i:i+self.query_size]
+                found.update(db.execute(u'SELECT key, %s FROM results WHERE key IN (%s)'
+                                        % (column, u', '.join([u'?'] * len(batch))), batch).fetchall())
+        return [found.get(key) for key in keys]
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        return [None if body is None else str(body) for body in self._select(u'body', keys)]
+
+    def exists(self, key):
+        return self.exists_many([key])[0]
+
+    def exists_many(self, keys):
+        return [found is not None for found in self._select(u'1', keys)]
+
+
+def open_result_store(location, concurrency=8):
+    """
+    The store a --storage location names: s3://bucket, sqlite:///path/to/results.sqlite, or a directory,
+    optionally as file:///path/to/dir
+    """
+    if location.startswith(u's3://'):
+        return S3ResultStore(bucket_name=location[len(u's3://'):].strip(u'/'), concurrency=concurrency)
+    if location.startswith(u'sqlite://'):
+        return SQLiteResultStore(location[len(u'sqlite://'):], concurrency=concurrency)
+    if location.startswith(u'file://'):
+        location = location[len(u'file://'):]
+    return LocalResultStore(location, concurrency=concurrency)
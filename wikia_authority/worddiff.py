@@ -0,0 +1,116 @@
+"""
+Word-level diffs between revisions, either scraped from the API's rendered diff or computed locally
+"""
+
+import difflib
+import re
+from collections import OrderedDict
+from lxml import etree
+from lxml import html
+
+
+# the same split MediaWiki's WordLevelDiff uses: runs of whitespace, runs of word characters,
+# or single other characters, each carrying one trailing space along with it
+word_pattern = re.compile(u'([^\\S\\n]+|[0-9_A-Za-z\u0080-\uffff]+|.)(?:[^\\S\\n])?', re.S)
+
+# every added or deleted cell of a rendered diff table, in one pass over the document
+changed_cells = etree.XPath(u"//td[contains(concat(' ', normalize-space(@class), ' '), ' diff-addedline ') or "
+                            u"contains(concat(' ', normalize-space(@class), ' '), ' diff-deletedline ')]")
+inline_changes = etree.XPath(u".//span[contains(concat(' ', normalize-space(@class), ' '), ' diffchange-inline ')]")
+
+
+def score_words(added, deleted):
+    """
+    Edit distance from the words that show up as changed in a diff. A word counts as moved rather
+    than added when it was deleted anywhere else in the diff, so membership is tested against hashed
+    sets of the other side, keeping this linear in the size of the diff.
+    """
+    added_words, deleted_words = frozenset(added), frozenset(deleted)
+    adds = sum([1 for word in added if word not in deleted_words])
+    deletes = sum([1 for word in deleted if word not in added_words])
+    moves = len(added) - adds
+    return max([adds, deletes]) - 0.5 * min([adds, deletes]) + moves
+
+
+def html_diff_words(diff_html):
+    """
+    (added, deleted) words from the inline change markers of a rendered MediaWiki diff table
+    """
+    added, deleted = [], []
+    for cell in changed_cells(html.fromstring(diff_html)):
+        words = added if u'diff-addedline' in cell.get(u'class').split() else deleted
+        for span in inline_changes(cell):
+            words += span.text_content().split(' ')
+    return added, deleted
+
+
+def split_words(lines):
+    words, stripped = [], []
+    for i, line in enumerate(lines):
+        if i > 0:
+            words.append(u'\n')
+            stripped.append(u'\n')
+        for match in word_pattern.finditer(line):
+            words.append(match.group(0))
+            stripped.append(match.group(1))
+    return words, stripped
+
+
+def changed_words(words):
+    # what text_content().split(' ') gives back for the inline spans a run of changed words renders as
+    return [word for line in u''.join(words).split(u'\n') if line != u'' for word in line.split(u' ')]
+
+
+def text_diff_words(old_text, new_text):
+    """
+    (added, deleted) words between two revisions' wikitext, worked out the way MediaWiki renders a diff:
+    lines are matched first, and only blocks of lines that were changed -- rather than purely added
+    or removed -- get a word-level diff. Purely added or removed lines have no inline markers, so
+    they don't count here either.
+    """
+    old_lines, new_lines = old_text.split(u'\n'), new_text.split(u'\n')
+    added, deleted = [], []
+    line_matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in line_matcher.get_opcodes():
+        if tag != u'replace':
+            continue
+        old_words, old_stripped = split_words(old_lines[i1:i2])
+        new_words, new_stripped = split_words(new_lines[j1:j2])
+        word_matcher = difflib.SequenceMatcher(None, old_stripped, new_stripped, autojunk=False)
+        for word_tag, k1, k2, l1, l2 in word_matcher.get_opcodes():
+            if word_tag == u'equal':
+                continue
+            deleted += changed_words(old_words[k1:k2])
+            added += changed_words(new_words[l1:l2])
+    return added, deleted
+
+
+class RevisionTextCache:
+    """
+    Wikitext for one page's revisions, fetched in batches as the revisions are walked in order.
+    A miss fetches that revision along with the next batch_size - 1 uncached ones after it; only the
+    most recently used `capacity` texts are held, since edit quality windows only look a few revisions ahead.
+    Revisions whose text can't be had come back as None.
+    """
+
+    def __init__(self, fetch_texts, revids, batch_size=50, capacity=200):
+        self.fetch_texts = fetch_texts
+        self.revids = list(revids)
+        self.positions = dict([(revid, i) for i, revid in enumerate(self.revids)])
+        self.batch_size = batch_size
+        self.capacity = max(capacity, batch_size)
+        self.texts = OrderedDict()
+
+    def get(self, revid):
+        if revid not in self.texts:
+            start = self.positions.get(revid)
+            wanted = [revid] if start is None else [r for r in self.revids[start:start + self.batch_size]
+                                                    if r not in self.texts]
+            fetched = self.fetch_texts(wanted)
+            for wanted_revid in wanted:
+                self.texts[wanted_revid] = fetched.get(wanted_revid)  # None for hidden or deleted text
+            while len(self.texts) > self.capacity:
+                self.texts.popitem(last=False)
+        text = self.texts.pop(revid)
+        self.texts[revid] = text
+        return text